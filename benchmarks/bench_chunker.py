@@ -0,0 +1,96 @@
+"""
+Benchmark of the sentence splitter and chunker of retrieval on texts from 1 KB to 100 MB.
+The text is streamed in 64 KB blocks through stream_sentences and chunk_sentences, as TextDocument.ingest does,
+the chunk offsets being checked against the text up to 1 MB.
+The former quadratic splitter (one slice per character and delimiter) is timed up to former_max bytes.
+
+usage: python benchmarks/bench_chunker.py [max_size] [former_max] [chunk_tokens] [overlap]
+"""
+import os
+import sys
+import time
+import resource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipy_agent.retrieval import SENTENCE_DELIMITERS, stream_sentences, chunk_sentences
+from ipy_agent.utils import token_count
+
+PARAGRAPH = (
+    "The quick brown fox jumps over the lazy dog. Is it really that quick? Nobody knows! "
+    "Measurements were taken: speed, agility; endurance... and style.\n"
+    "Une phrase en français, pour varier les caractères. 数字和文字。\n\n"
+)
+
+def former_split_string(string, delimiters):
+    substrings = []
+    current_substring = ""
+    i = 0
+    while i < len(string):
+        for delimiter in delimiters:
+            if string[i:].startswith(delimiter):
+                current_substring += delimiter
+                if current_substring:
+                    substrings.append(current_substring)
+                    current_substring = ""
+                i += len(delimiter)
+                break
+        else:
+            current_substring += string[i]
+            i += 1
+    if current_substring:
+        substrings.append(current_substring)
+    return substrings
+
+def former_split_text(text, max_tokens):
+    chunks = []
+    current_chunk = ""
+    current_token_count = 0
+    for sentence in former_split_string(text, delimiters=SENTENCE_DELIMITERS):
+        sentence_token_count = token_count(sentence)
+        if current_token_count + sentence_token_count > max_tokens:
+            chunks.append(current_chunk.strip())
+            current_chunk = ""
+            current_token_count = 0
+        current_chunk += sentence
+        current_token_count += sentence_token_count
+    if current_chunk.strip():
+        chunks.append(current_chunk.strip())
+    return chunks
+
+def blocks(size, block_size=65536):
+    block = PARAGRAPH * (block_size // len(PARAGRAPH) + 1)
+    for start in range(0, size, len(block)):
+        yield block[:min(len(block), size - start)]
+
+def run(size, chunk_tokens, overlap):
+    text = ''.join(blocks(size)) if size <= 2**20 else None
+    chunks = 0
+    covered = 0
+    start = time.perf_counter()
+    for first, last, chunk in chunk_sentences(stream_sentences(blocks(size)), chunk_tokens, overlap=overlap):
+        chunks += 1
+        if text is not None:
+            assert text[first:last] == chunk
+        covered = max(covered, last)
+    elapsed = time.perf_counter() - start
+    if text is not None:
+        assert not text[covered:].strip()
+    return elapsed, chunks
+
+def main(max_size=100 * 2**20, former_max=100 * 2**10, chunk_tokens=500, overlap=50):
+    print(f"chunks of {chunk_tokens} tokens, overlap {overlap}")
+    print(f"{'size':>10}{'chunks':>10}{'time (s)':>12}{'MB/s':>10}{'former (s)':>12}{'max rss (MB)':>14}")
+    size = 2**10
+    while size <= max_size:
+        elapsed, chunks = run(size, chunk_tokens, overlap)
+        former = ''
+        if size <= former_max:
+            text = ''.join(blocks(size))
+            start = time.perf_counter()
+            former_split_text(text, chunk_tokens)
+            former = f"{time.perf_counter() - start:.3f}"
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        print(f"{size:>10}{chunks:>10}{elapsed:>12.3f}{size / 2**20 / elapsed:>10.1f}{former:>12}{rss:>14.0f}")
+        size *= 10
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:5]))
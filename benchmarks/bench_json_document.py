@@ -0,0 +1,94 @@
+"""
+Benchmark of the key trie of JsonDocument on a 100k-leaf in-memory document:
+subtree lookup (doc[a][b][c]), containment, value reconstruction and deletion,
+against the former linear prefix scans over every entry of the document.
+Embeddings are random vectors, so that only the document structure is measured.
+
+usage: python benchmarks/bench_json_document.py [leaves] [repeat]
+"""
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipy_agent.retrieval import JsonDocument, Item, is_prefix, keys_as_str, builder
+
+class RandomEmbedder:
+
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+
+    def embed(self, strings, precision, dimensions, progress=None):
+        vects = self.rng.standard_normal((len(strings), dimensions)).astype(np.float32)
+        return vects / np.linalg.norm(vects, axis=1, keepdims=True)
+
+def sample_data(leaves):
+    # 10 leaves per section
+    return {
+        f"section{i}": dict(title=f"Section {i}", items=list(range(i, i + 7)), meta=dict(owner=f"user{i % 97}", size=i * 3))
+        for i in range(leaves // 10)
+    }
+
+def former_content(document, keys):
+    return {keys_as_str(entry['keys']): entry for entry in document.data['content'].values() if is_prefix(keys, entry['keys'])}
+
+def former_lookup(document, path):
+    keys = []
+    for key in path:
+        content = former_content(document, keys)
+        keys = keys + [key]
+        if not any(is_prefix(keys, entry['keys']) for entry in content.values()):
+            raise KeyError(key)
+    return keys
+
+def former_value(document, keys):
+    return builder([(entry['keys'][len(keys):], entry['value']) for entry in former_content(document, keys).values()])
+
+def lookup(document, path):
+    item = document
+    for key in path:
+        item = item[key]
+    return item.keys
+
+def best_of(repeat, function, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main(leaves=100000, repeat=5):
+    data = sample_data(leaves)
+    doc = JsonDocument(store=RandomEmbedder())
+    start = time.perf_counter()
+    doc.load_data('bench', data, 'benchmark document', precision=5, dimensions=64)
+    print(f"{len(doc.data['content'])} leaves loaded in {time.perf_counter() - start:.2f} s")
+    section = f"section{len(data) // 2}"
+    path = [section, 'items', 4]
+    runs = (
+        ("lookup doc[a][b][c]", former_lookup, lookup, (doc, path)),
+        ("containment", lambda doc, path: any(is_prefix(path, entry['keys']) for entry in doc.data['content'].values()), lambda doc, path: doc.tree.find(path) is not None, (doc, path)),
+        ("value of a section", former_value, lambda doc, keys: Item(document=doc, keys=keys).value, (doc, [section])),
+    )
+    print(f"{'operation':<24}{'former (ms)':>14}{'trie (ms)':>12}{'speedup':>10}")
+    for name, former, current, args in runs:
+        before, expected = best_of(repeat, former, *args)
+        after, result = best_of(repeat, current, *args)
+        assert result == expected
+        print(f"{name:<24}{before * 1000:>14.3f}{after * 1000:>12.3f}{before / after:>9.0f}x")
+    # Deletion is measured once, on distinct sections: the former code scanned every entry to find those of the section
+    sections = [f"section{i}" for i in range(repeat)]
+    start = time.perf_counter()
+    for section in sections:
+        former_content(doc, [section])
+    before = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for section in sections:
+        doc.delete_value([section])
+    after = (time.perf_counter() - start) / repeat
+    assert not any(section in doc for section in sections)
+    print(f"{'delete a section':<24}{before * 1000:>14.3f}{after * 1000:>12.3f}{before / after:>9.0f}x")
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
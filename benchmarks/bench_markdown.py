@@ -0,0 +1,55 @@
+"""
+Bytes sent over the notebook display channel while streaming a markdown response, token by token,
+with the throttled MarkdownOutput (max_fps=20) versus one full update per token (the former behavior).
+The stream is replayed on a simulated clock, at a given rate of tokens per second.
+
+usage: python benchmarks/bench_markdown.py [tokens] [tokens_per_second]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from types import SimpleNamespace
+from IPython.core.interactiveshell import InteractiveShell
+
+# init_shell registers its magics on the running shell
+InteractiveShell.instance()
+import ipy_agent.init_shell as init_shell
+from ipy_agent.utils import tokenize
+
+PARAGRAPH = (
+    "The rest energy is \\(E=mc^2\\), and for a moving particle \\[E^2=(pc)^2+(mc^2)^2\\]. "
+    "Let's check it numerically:\n```run_python\nc=299792458\nm=1e-3\nprint(m*c**2)\n```\n"
+    "Which gives about **89.9 TJ** for a single gram of matter.\n\n"
+)
+
+def sample_tokens(tokens):
+    paragraph = tokenize(PARAGRAPH)
+    return (paragraph * (tokens // len(paragraph) + 1))[:tokens]
+
+def stream(tokens, max_fps, rate):
+    clock = SimpleNamespace(now=0.0)
+    init_shell.time = SimpleNamespace(monotonic=lambda: clock.now)
+    init_shell.display = lambda *args, **kwargs: None
+    output = init_shell.MarkdownOutput(max_fps=max_fps)
+    output.is_notebook = True
+    start = time.perf_counter()
+    output.display('', update=False)
+    for token in tokens:
+        clock.now += 1 / rate
+        output.display(token, update=True)
+    output.flush()
+    return output, time.perf_counter() - start
+
+def main(tokens=4000, rate=50.0):
+    tokens = sample_tokens(tokens)
+    expected = init_shell.rewrite_md(''.join(tokens))
+    print(f"{len(tokens)} tokens, {len(expected.encode('utf-8'))} bytes of markdown, streamed at {rate:g} tokens/s")
+    print(f"{'mode':<16}{'updates':>10}{'bytes sent':>16}{'cpu (s)':>10}")
+    for mode, max_fps in (("per token", float('inf')), ("max_fps=20", 20)):
+        output, elapsed = stream(tokens, max_fps, rate)
+        assert output.current_content == expected
+        print(f"{mode:<16}{output.flushes:>10}{output.bytes_sent:>16}{elapsed:>10.3f}")
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]), *(float(arg) for arg in sys.argv[2:3]))
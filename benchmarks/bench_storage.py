@@ -0,0 +1,93 @@
+"""
+Benchmark of document loading: load time and peak RSS of a text document stored in the former layout
+(embeddings inlined in the json file as lists of 5-decimal floats) versus the current one
+(json metadata, .entries file and .npy sidecar opened with mmap), loaded eagerly and lazily.
+Each load runs in a fresh process, so that its peak RSS is measured alone.
+
+usage: python benchmarks/bench_storage.py [chunks] [dimensions]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipy_agent.retrieval import TextDocument, FORMAT_VERSION
+
+def write_former(file, chunks, dimensions, precision=5):
+    rng = np.random.default_rng(0)
+    content = {}
+    offset = 0
+    for i in range(chunks):
+        string = f"Chunk {i} of the benchmark document, long enough to look like a paragraph of real text. " * 4
+        vect = rng.standard_normal(dimensions)
+        vect /= np.linalg.norm(vect)
+        keys = [offset + 1, offset + len(string)]
+        offset += len(string)
+        content[str(keys)] = dict(keys=keys, string=string, embedding=[round(float(x), precision) for x in vect])
+    with open(file, 'w') as f:
+        json.dump(dict(title='bench', type='text', description='benchmark document', precision=precision, dimensions=dimensions, content=content), f)
+
+def folder_size(folder, prefix):
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder) if name.startswith(prefix + '.'))
+
+def measure(mode, file):
+    """
+    loads the document in the current process and scores its embeddings against one of them, so that they are actually read.
+    Returns the time taken and the peak RSS growth.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if mode == 'former':
+        # The former code kept the parsed json as is
+        with open(file) as f:
+            data = json.load(f)
+        doc = TextDocument(store=None, file=file)
+        doc.data = data
+        vect = np.array(next(iter(data['content'].values()))['embedding'])
+        scores = [np.dot(vect, entry['embedding']) for entry in data['content'].values()]
+    else:
+        doc = TextDocument(store=None, file=file)
+        doc.load(lazy=mode == 'lazy')
+        scores = doc.index.scores(doc.index.values[0])
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    assert len(scores) == len(doc.data['content'])
+    return dict(time=elapsed, rss=peak * 1024)
+
+def prepare(folder, chunks, dimensions):
+    former = os.path.join(folder, 'former.json')
+    write_former(former, chunks, dimensions)
+    doc = TextDocument(store=None, file=former)
+    doc.load()
+    doc.compact(os.path.join(folder, 'current.json'))
+
+def run(*args):
+    # A child process starts with the peak RSS of its parent: this one stays small
+    output = subprocess.run([sys.executable, __file__, *map(str, args)], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1]) if output.strip() else None
+
+def main(chunks=100000, dimensions=128):
+    folder = tempfile.mkdtemp()
+    run('--prepare', folder, chunks, dimensions)
+    former = os.path.join(folder, 'former.json')
+    current = os.path.join(folder, 'current.json')
+    print(f"{chunks} chunks of {dimensions} dimensions")
+    print(f"former layout: {folder_size(folder, 'former') / 2**20:.1f} MB, format {FORMAT_VERSION} layout: {folder_size(folder, 'current') / 2**20:.1f} MB")
+    print(f"{'load':<24}{'time (s)':>10}{'peak rss (MB)':>16}")
+    for label, mode, file in (("former (json floats)", 'former', former), ("current, eager", 'eager', current), ("current, lazy", 'lazy', current)):
+        result = run('--measure', mode, file)
+        print(f"{label:<24}{result['time']:>10.3f}{result['rss'] / 2**20:>16.1f}")
+    shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        print(json.dumps(measure(*sys.argv[2:4])))
+    elif sys.argv[1:2] == ['--prepare']:
+        prepare(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,56 @@
+"""
+Micro-benchmarks of utils.tokenize, utils.truncate and utils.token_count_many on 1 KB and 1 MB messages,
+against the former implementations (one decode call per token, truncation by joining the decoded tokens).
+
+usage: python benchmarks/bench_tokens.py [repeat]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ipy_agent.utils import tokenizer, tokenize, truncate, token_count, token_count_many
+
+def former_tokenize(string):
+    return [tokenizer.decode([int_token]) for int_token in tokenizer.encode(string)]
+
+def former_truncate(string, max_tokens=2000):
+    tokens = former_tokenize(string)
+    if len(tokens) > max_tokens:
+        removed = len(tokens) - max_tokens
+        truncated = tokens[:max_tokens // 2] + [f"\n\n#####\n\n[Maximal message size reached: {removed} tokens truncated]\n\n#####\n\n"] + tokens[-max_tokens // 2:]
+        return ''.join(truncated)
+    return string
+
+def sample_text(size):
+    line = "Observation: the function returned {'status': 'ok', 'rows': 1024, 'elapsed': 0.0421} après 3 essais.\n"
+    return (line * (size // len(line) + 1))[:size]
+
+def best_of(repeat, function, *args):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(repeat=5):
+    print(f"{'benchmark':<34}{'size':>8}{'former (ms)':>14}{'current (ms)':>14}{'speedup':>10}")
+    for label, size in (("1 KB", 2**10), ("1 MB", 2**20)):
+        text = sample_text(size)
+        strings = [sample_text(size // 64)] * 64
+        runs = (
+            ("tokenize", former_tokenize, tokenize, (text,)),
+            ("truncate (max_tokens=2000)", former_truncate, truncate, (text,)),
+            ("token count, 64 strings", lambda strings: [token_count(string) for string in strings], token_count_many, (strings,)),
+        )
+        for name, former, current, args in runs:
+            # Truncated texts may differ where a character spans several tokens, decoded one by one in the former code
+            if former is not former_truncate:
+                assert former(*args) == current(*args)
+            # Fewer runs of the slow former code on large inputs
+            before = best_of(repeat if size < 2**20 else 1, former, *args)
+            after = best_of(repeat, current, *args)
+            print(f"{name:<34}{label:>8}{before * 1000:>14.2f}{after * 1000:>14.2f}{before / after:>9.1f}x")
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,71 @@
+import hashlib
+import time
+import numpy as np
+from .sqlite_cache import SQLiteCache
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache(SQLiteCache):
+    """
+    Persistent content-addressed cache of raw embeddings, stored in a SQLite file.
+    Entries are keyed by (model, dimensions, sha256 of the text) and evicted in LRU order above max_entries.
+    """
+
+    table="embeddings"
+    columns="""
+        model TEXT,
+        dimensions INTEGER,
+        hash TEXT,
+        vector BLOB,
+        last_used REAL,
+        PRIMARY KEY (model,dimensions,hash)
+    """
+
+    def __init__(self,file,max_entries=100000):
+        SQLiteCache.__init__(self,file,capacity=max_entries)
+
+    @property
+    def max_entries(self):
+        return self.capacity
+
+    def get_many(self,model,dimensions,strings):
+        """
+        returns a list aligned with strings, holding the cached vector or None for each string
+        """
+        hashes=[text_hash(string) for string in strings]
+        found={}
+        with self.lock:
+            unique=list(set(hashes))
+            # Stay below SQLite's limit on the number of bound variables
+            for i in range(0,len(unique),500):
+                batch=unique[i:i+500]
+                rows=self.conn.execute(
+                    f"SELECT hash,vector FROM embeddings WHERE model=? AND dimensions=? AND hash IN ({','.join('?'*len(batch))})",
+                    [model,dimensions,*batch]
+                ).fetchall()
+                found.update((h,np.frombuffer(vector,dtype=np.float32)) for h,vector in rows)
+            if found:
+                now=time.time()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used=? WHERE model=? AND dimensions=? AND hash=?",
+                    [(now,model,dimensions,h) for h in found]
+                )
+                self.conn.commit()
+            results=[found.get(h) for h in hashes]
+            hits=sum(result is not None for result in results)
+            self.count(hits,len(results)-hits)
+        return results
+
+    def set_many(self,model,dimensions,strings,vectors):
+        now=time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?,?,?,?,?)",
+                [(model,dimensions,text_hash(string),np.asarray(vector,dtype=np.float32).tobytes(),now) for string,vector in zip(strings,vectors)]
+            )
+            self.evict()
+            self.conn.commit()
+
+    def stats(self):
+        return dict(SQLiteCache.stats(self),max_entries=self.max_entries)
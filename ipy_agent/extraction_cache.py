@@ -0,0 +1,72 @@
+import time
+import os
+try:
+    from .sqlite_cache import SQLiteCache, content_hash
+except ImportError:
+    from sqlite_cache import SQLiteCache, content_hash
+
+class ExtractionCache(SQLiteCache):
+    """
+    Persistent cache of the text extracted from files, stored in a SQLite file.
+    Entries are keyed by the file's (path, size, mtime) - or by its content hash if use_hash is set -
+    the extraction options and the parser version, and evicted in LRU order above max_bytes of text.
+    """
+
+    table="extractions"
+    columns="""
+        key TEXT PRIMARY KEY,
+        text TEXT,
+        size INTEGER,
+        last_used REAL
+    """
+    weight="size"
+
+    def __init__(self,file,max_bytes=200*2**20,use_hash=False):
+        self.use_hash=use_hash
+        SQLiteCache.__init__(self,file,capacity=max_bytes)
+
+    @property
+    def max_bytes(self):
+        return self.capacity
+
+    def key(self,path,options,version):
+        if self.use_hash:
+            identity=content_hash(path)
+        else:
+            stat=os.stat(path)
+            identity=f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+        return f"{identity}|{options!r}|{version}"
+
+    def get(self,key):
+        with self.lock:
+            row=self.conn.execute("SELECT text FROM extractions WHERE key=?",(key,)).fetchone()
+            if row:
+                self.conn.execute("UPDATE extractions SET last_used=? WHERE key=?",(time.time(),key))
+                self.conn.commit()
+            self.count(int(row is not None),int(row is None))
+        return row[0] if row else None
+
+    def set(self,key,text):
+        size=len(text.encode('utf-8'))
+        if size>self.max_bytes:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO extractions VALUES (?,?,?,?)",(key,text,size,time.time()))
+            self.evict()
+            self.conn.commit()
+
+    def extract(self,path,options,version,parser):
+        """
+        returns the cached text for this file, options and parser version, or parses the file with parser() and caches the result
+        """
+        key=self.key(path,options,version)
+        text=self.get(key)
+        if text is None:
+            text=parser()
+            self.set(key,text)
+        return text
+
+    def stats(self):
+        with self.lock:
+            size=self.total_weight()
+        return dict(SQLiteCache.stats(self),bytes=size,max_bytes=self.max_bytes)
@@ -6,16 +6,37 @@ if not sys.path[0]==_root_:
 def root_join(*args):
     return os.path.join(_root_,*args)
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 import PyPDF2
 import docx
 import odf
+import odf.opendocument
+import odf.text
+import odf.teletype
 import os
+import re
+import time
+import hashlib
+import shutil
 import requests
+from selenium.common.exceptions import WebDriverException
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
 from io import BytesIO
 import json
 import inspect
-from get_webdriver import get_webdriver
+try:
+    from .get_webdriver import browser_pool
+    from .utils import token_count
+    from .extraction_cache import ExtractionCache
+    from .sqlite_cache import content_hash
+except ImportError:
+    from get_webdriver import browser_pool
+    from utils import token_count
+    from extraction_cache import ExtractionCache
+    from sqlite_cache import content_hash
 
 def strip_newlines(string):
     while len(string)>=1 and string[0]=='\n':
@@ -49,14 +70,345 @@ def handle_directory(path):
     else:
         return f'The path {path} is not a valid directory.'
 
+def html_to_text(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    for tag in soup(['script', 'style', 'template']):
+        tag.decompose()
+    return strip_newlines(soup.get_text())
+
+def needs_javascript(html, text):
+    """
+    guesses whether a static HTML page only renders its content with javascript
+    """
+    if len(text) >= 1000:
+        return False
+    if re.search(r'<noscript[^>]*>[^<]*(enable|requires?)[^<]*javascript', html, re.IGNORECASE):
+        return True
+    if re.search(r'<div[^>]+id=["\'](root|app|__next|__nuxt)["\'][^>]*>\s*</div>', html, re.IGNORECASE):
+        return True
+    return len(text) < 200 and '<script' in html.lower()
+
 def extract_webpage_content(url):
-    driver = get_webdriver()
-    driver.get(url)
-    page_source = driver.page_source
-    soup = BeautifulSoup(page_source, 'html.parser')
-    text = soup.get_text()
-    driver.quit()
-    return strip_newlines(text)
+    with browser_pool().session() as driver:
+        driver.get(url)
+        page_source = driver.page_source
+    return html_to_text(page_source)
+
+class PageCache:
+    """
+    On-disk cache of the text of PDF pages, keyed by the file (see pdf_key) and the page number.
+    The pages of each file are stored in a folder of their own, whose mtime tracks the last use of the file:
+    above max_bytes, the folders of the least recently used files are removed.
+    """
+
+    def __init__(self, folder, max_bytes=500 * 2**20):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.size = sum(size for _, _, size in self.files())
+
+    def files(self):
+        """
+        (last use, hash, bytes) of each cached file
+        """
+        files = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                files.append((os.path.getmtime(path), name, size))
+            except OSError:
+                # Not a folder, or removed meanwhile by another process
+                continue
+        return files
+
+    def evict(self, keep=None):
+        files = sorted(self.files())
+        total = sum(size for _, _, size in files)
+        for _, name, size in files:
+            if total <= self.max_bytes:
+                break
+            if name != keep:
+                shutil.rmtree(os.path.join(self.folder, name), ignore_errors=True)
+                total -= size
+        self.size = total
+
+    def path(self, key, name):
+        return os.path.join(self.folder, key, name)
+
+    def read(self, key, name):
+        try:
+            with open(self.path(key, name), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write(self, key, name, text):
+        path = self.path(key, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+        self.size += len(text.encode('utf-8'))
+        if self.size > self.max_bytes:
+            self.evict(keep=key)
+
+    def get(self, key, page):
+        return self.read(key, f"{page}.txt")
+
+    def set(self, key, page, text):
+        self.write(key, f"{page}.txt", text)
+
+    def get_count(self, key):
+        count = self.read(key, "count")
+        if count:
+            # Mark the file as recently used
+            try:
+                os.utime(os.path.join(self.folder, key))
+            except OSError:
+                pass
+        return int(count) if count else None
+
+    def set_count(self, key, count):
+        self.write(key, "count", str(count))
+
+_page_cache = None
+
+def configure_page_cache(folder, **kwargs):
+    global _page_cache
+    _page_cache = PageCache(folder, **kwargs) if folder else None
+    return _page_cache
+
+def pdf_key(source):
+    """
+    page cache key of a PDF: its (path, size, mtime) for a file, which avoids reading it, or the hash of its bytes
+    """
+    if isinstance(source, bytes):
+        return content_hash(source)
+    stat = os.stat(source)
+    return hashlib.sha256(f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}".encode('utf-8')).hexdigest()
+
+class PDFPages:
+    """
+    Lazy access to the text of the pages of a PDF (path or bytes), through the page cache.
+    The PDF is only parsed when a page is missing from the cache.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.cache = _page_cache
+        self.key = pdf_key(source) if self.cache else None
+        self._reader = None
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = PyPDF2.PdfReader(BytesIO(self.source) if isinstance(self.source, bytes) else self.source)
+        return self._reader
+
+    def __len__(self):
+        count = self.cache.get_count(self.key) if self.cache else None
+        if count is None:
+            count = len(self.reader.pages)
+            if self.cache:
+                self.cache.set_count(self.key, count)
+        return count
+
+    def __getitem__(self, page):
+        text = self.cache.get(self.key, page) if self.cache else None
+        if text is None:
+            text = self.reader.pages[page].extract_text() or ""
+            if self.cache:
+                self.cache.set(self.key, page, text)
+        return text
+
+    def indices(self, pages=None):
+        """
+        page indices of the (first, last) range of page numbers, counted from 1 and inclusive
+        """
+        if pages is None:
+            return range(len(self))
+        first, last = pages
+        return range(max(first, 1) - 1, min(last, len(self)))
+
+def iter_pdf_pages(source, pages=None, reverse=False):
+    """
+    yields (page number, text) for the pages of a PDF (path, bytes or PDFPages),
+    optionally restricted to a (first, last) range of page numbers, from the last page if reverse is set.
+    Pages are only extracted as they are consumed.
+    """
+    pdf = source if isinstance(source, PDFPages) else PDFPages(source)
+    indices = pdf.indices(pages)
+    for index in reversed(indices) if reverse else indices:
+        yield index + 1, pdf[index]
+
+def extract_pdf(source, pages=None, max_tokens=None):
+    """
+    returns the text of a PDF (path or bytes), optionally restricted to a (first, last) range of page numbers.
+    With max_tokens, only the first and last pages are extracted, until each reaches max_tokens/2 tokens.
+    """
+    pdf = PDFPages(source)
+    if max_tokens is None:
+        return '\n'.join(text for _, text in iter_pdf_pages(pdf, pages))
+    budget = max_tokens // 2
+    head = []
+    tokens = 0
+    for number, text in iter_pdf_pages(pdf, pages):
+        head.append((number, text))
+        tokens += token_count(text)
+        if tokens >= budget:
+            break
+    last = head[-1][0] if head else 0
+    tail = []
+    tokens = 0
+    for number, text in iter_pdf_pages(pdf, pages, reverse=True):
+        if number <= last:
+            break
+        tail.append((number, text))
+        tokens += token_count(text)
+        if tokens >= budget:
+            break
+    tail.reverse()
+    text = '\n'.join(text for _, text in head)
+    if tail and tail[0][0] > last + 1:
+        text += f"\n\n#####\n\n[Pages {last + 1} to {tail[0][0] - 1} not extracted]\n\n#####\n\n"
+    elif tail:
+        text += '\n'
+    return text + '\n'.join(text for _, text in tail)
+
+def parse_docx(file):
+    doc = docx.Document(file)
+    return "\n".join([para.text for para in doc.paragraphs])
+
+def parse_odt(file):
+    doc = odf.opendocument.load(file)
+    allparas = doc.getElementsByType(odf.text.P)
+    return '\n'.join([odf.teletype.extractText(para) for para in allparas])
+
+DOCUMENT_PARSERS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': parse_docx,
+    'application/vnd.oasis.opendocument.text': parse_odt
+}
+
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+
+TEXT_TYPES = ('text/plain', 'text/markdown', 'text/csv', 'text/xml', 'application/xml', 'application/json')
+
+class HTTPCache:
+    """
+    On-disk cache of HTTP responses, revalidated with ETag / Last-Modified.
+    A response is reused without any request while it is fresh (Cache-Control max-age, or default_ttl seconds),
+    then revalidated with a conditional request. At most max_entries responses are kept, the oldest being evicted.
+    """
+
+    def __init__(self, folder, default_ttl=300, max_entries=1000):
+        self.folder = folder
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def path(self, url):
+        return os.path.join(self.folder, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        path = self.path(url)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def ttl(self, headers):
+        cache_control = headers.get('cache-control', '').lower()
+        if 'no-store' in cache_control:
+            return None
+        if 'no-cache' in cache_control:
+            return 0
+        match = re.search(r'max-age=(\d+)', cache_control)
+        return int(match.group(1)) if match else self.default_ttl
+
+    def set(self, url, response):
+        ttl = self.ttl(response.headers)
+        if ttl is None:
+            return
+        meta = dict(
+            url=url,
+            content_type=response.headers.get('content-type', ''),
+            etag=response.headers.get('etag'),
+            last_modified=response.headers.get('last-modified'),
+            expires=time.time() + ttl
+        )
+        path = self.path(url)
+        with open(path + '.body', 'wb') as f:
+            f.write(response.content)
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+        self.evict()
+
+    def refresh(self, url, meta, headers):
+        ttl = self.ttl(headers)
+        meta['expires'] = time.time() + (self.default_ttl if ttl is None else ttl)
+        with open(self.path(url) + '.json', 'w') as f:
+            json.dump(meta, f)
+
+    def evict(self):
+        entries = sorted((entry.stat().st_mtime, entry.path[:-5]) for entry in os.scandir(self.folder) if entry.name.endswith('.json'))
+        for _, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            for ext in ('.json', '.body'):
+                try:
+                    os.remove(path + ext)
+                except OSError:
+                    pass
+
+_http_cache = None
+_session = None
+_session_lock = Lock()
+
+def configure_http_cache(folder, **kwargs):
+    global _http_cache
+    _http_cache = HTTPCache(folder, **kwargs) if folder else None
+    return _http_cache
+
+def http_session():
+    """
+    returns the shared requests session, keeping connections alive across fetches
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session.headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0'
+        return _session
+
+def fetch_url(url, timeout=20):
+    """
+    fetches a url through the HTTP cache, returns a dict with content_type and content (bytes)
+    """
+    cache = _http_cache
+    cached = cache.get(url) if cache else None
+    headers = {}
+    if cached:
+        meta, content = cached
+        if time.time() < meta['expires']:
+            return dict(content_type=meta['content_type'], content=content)
+        if meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+    response = http_session().get(url, headers=headers, timeout=timeout)
+    if cached and response.status_code == 304:
+        cache.refresh(url, meta, response.headers)
+        return dict(content_type=meta['content_type'], content=content)
+    if cache and response.status_code == 200:
+        cache.set(url, response)
+    return dict(content_type=response.headers.get('content-type', ''), content=response.content)
  
 def handle_class(source):
     class_info = {
@@ -250,62 +602,90 @@ def handle_object(source):
     # Serialize the instance information
     return json.dumps(instance_info, indent=4)    
 
-def handle_url(source):
+def decode_content(fetched, is_html=False):
+    """
+    decodes a response with the charset of its content type if any,
+    otherwise with the one declared in the document (<meta charset>, BOM) or detected from its bytes
+    """
+    match = re.search(r'charset=["\']?([\w-]+)', fetched['content_type'], re.IGNORECASE)
+    known = [match.group(1)] if match else []
+    dammit = UnicodeDammit(fetched['content'], known_definite_encodings=known, is_html=is_html)
+    if dammit.unicode_markup is None:
+        return fetched['content'].decode('utf-8', errors='replace')
+    return dammit.unicode_markup
+
+def handle_url(source, pages=None, max_tokens=None):
     url = source
     try:
-        response = requests.get(url)
-        content_type = response.headers['content-type']
+        fetched = fetch_url(url)
+        content_type = fetched['content_type'].split(';')[0].strip().lower()
         if content_type == 'application/pdf':
-            with BytesIO(response.content) as file:
-                reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page_num in range(len(reader.pages)):
-                    text += reader.pages[page_num].extract_text()
-        elif content_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
-            with BytesIO(response.content) as file:
-                doc = docx.Document(file)
-                text = "\n".join([para.text for para in doc.paragraphs])
-        elif content_type == 'application/vnd.oasis.opendocument.text':
-            with BytesIO(response.content) as file:
-                doc = odf.opendocument.load(file)
-                allparas = doc.getElementsByType(odf.text.P)
-                text='\n'.join([odf.teletype.extractText(para) for para in allparas])
+            text = extract_pdf(fetched['content'], pages=pages, max_tokens=max_tokens)
+        elif content_type in DOCUMENT_PARSERS:
+            with BytesIO(fetched['content']) as file:
+                text = DOCUMENT_PARSERS[content_type](file)
+        elif content_type in HTML_TYPES:
+            # Parse the page we already have, only render it in a browser if it needs javascript
+            html = decode_content(fetched, is_html=True)
+            text = html_to_text(html)
+            if needs_javascript(html, text):
+                text = extract_webpage_content(url)
+        elif content_type in TEXT_TYPES:
+            text = decode_content(fetched)
         else:
             text = extract_webpage_content(url)
         return text
     except requests.exceptions.RequestException as e:
         return f"Unable to process url. Connexion error : {e}"
+    except TimeoutError as e:
+        return f"Unable to process url. No browser available : {e}"
+    except WebDriverException as e:
+        # e.g. the page load timeout of the browser pool
+        return f"Unable to process url. Browser error : {e}"
+
+# Bump when the text extracted from files changes, to invalidate the extraction cache
+PARSER_VERSION = 1
+
+CACHED_EXTENSIONS = ('.pdf', '.docx', '.odt', '.html')
+
+_extraction_cache = None
 
-def handle_file(source):
+def configure_extraction_cache(file, **kwargs):
+    global _extraction_cache
+    _extraction_cache = ExtractionCache(file, **kwargs) if file else None
+    return _extraction_cache
+
+def parse_file(source, pages=None, max_tokens=None):
     ext = os.path.splitext(source)[1]
+    if ext == '.pdf':
+        text = extract_pdf(source, pages=pages, max_tokens=max_tokens)
+    elif ext == '.docx':
+        text = parse_docx(source)
+    elif ext == '.odt':
+        text = parse_odt(source)
+    elif ext == '.html':
+        with open(source, 'r') as f:
+            soup = BeautifulSoup(f, 'html.parser')
+            text = soup.get_text()
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            text = f.read()
+    return text
+
+def handle_file(source, pages=None, max_tokens=None):
     try:
-        if ext == '.pdf':
-            with open(source, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page_num in range(len(reader.pages)):
-                    text += reader.pages[page_num].extract_text()
-        elif ext == '.docx':
-            doc = docx.Document(source)
-            text = "\n".join([para.text for para in doc.paragraphs])
-        elif ext == '.odt':
-            doc = odf.opendocument.load(source)
-            allparas = doc.getElementsByType(odf.text.P)
-            text='\n'.join([odf.teletype.extractText(para) for para in allparas])
-        elif ext == '.html':
-            with open(source, 'r') as f:
-                soup = BeautifulSoup(f, 'html.parser')
-                text = soup.get_text()
-        else:
-            with open(source, 'r', encoding='utf-8') as f:
-                text = f.read()
-        return text
+        cache = _extraction_cache
+        if cache is not None and os.path.splitext(source)[1] in CACHED_EXTENSIONS:
+            # Only the pdf extraction depends on the options
+            options = (pages, max_tokens) if source.endswith('.pdf') else None
+            return cache.extract(source, options, PARSER_VERSION, lambda: parse_file(source, pages=pages, max_tokens=max_tokens))
+        return parse_file(source, pages=pages, max_tokens=max_tokens)
     except FileNotFoundError:
         return f"Unable to process file. File not found : {source}"
     except Exception as e:
         return f"Error while attempting to read file : {e}"
 
-def get_text(source):
+def get_text(source, pages=None, max_tokens=None):
     if not isinstance(source,str):
         # Then check for classes
         if inspect.isclass(source):
@@ -330,10 +710,10 @@ def get_text(source):
             text=repr(source)
 
     elif source.startswith('http'):
-        text=handle_url(source)
+        text=handle_url(source, pages=pages, max_tokens=max_tokens)
 
     elif os.path.isfile(source):
-        text=handle_file(source)
+        text=handle_file(source, pages=pages, max_tokens=max_tokens)
 
     elif os.path.isdir(source):
         text=handle_directory(source)
@@ -341,4 +721,105 @@ def get_text(source):
     else:
         text = source
         
-    return strip_newlines(text)
\ No newline at end of file
+    return strip_newlines(text)
+
+PARSED_EXTENSIONS = ('.pdf', '.docx', '.odt')
+
+def extract_source(source, pages=None, max_tokens=None):
+    try:
+        return get_text(source, pages=pages, max_tokens=max_tokens)
+    except Exception as e:
+        return f"Error while extracting {source!r}: {e}"
+
+def worker_settings():
+    """
+    settings of the caches of this process, passed on to the worker processes of get_text_many
+    """
+    return dict(
+        page_cache=_page_cache.folder if _page_cache else None,
+        page_options=dict(max_bytes=_page_cache.max_bytes) if _page_cache else {},
+        extraction_cache=_extraction_cache.file if _extraction_cache is not None else None,
+        extraction_options=dict(max_bytes=_extraction_cache.max_bytes, use_hash=_extraction_cache.use_hash) if _extraction_cache is not None else {}
+    )
+
+def init_worker(settings):
+    configure_page_cache(settings['page_cache'], **settings['page_options'])
+    configure_extraction_cache(settings['extraction_cache'], **settings['extraction_options'])
+
+def worker_module():
+    # Worker processes start from a fresh interpreter whose sys.path begins with this folder (see the top of the file),
+    # where the package name would resolve to ipy_agent.py: they must find their functions in the top-level module get_text
+    import get_text
+    return get_text
+
+def process_context():
+    # Forking a process holding threads (browser pool, http session, IPython) may deadlock the child
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def get_text_many(sources, workers=8, timeout=60, pages=None, max_tokens=None):
+    """
+    extracts the text of several sources in parallel, returning the texts in the same order.
+    Urls are fetched in a thread pool, pdf/docx/odt files are parsed in a process pool, other sources are handled inline.
+    A source failing, or still running timeout seconds after it started, yields an error message instead of its text.
+    pages and max_tokens apply to each source, as in get_text.
+    """
+    sources = list(sources)
+    futures = {}
+    pools = {}
+    owners = {}
+    threads = processes = None
+    for i, source in enumerate(sources):
+        if isinstance(source, str) and source.startswith('http'):
+            if threads is None:
+                threads = ThreadPoolExecutor(max_workers=workers)
+                pools[threads] = workers
+            futures[i] = threads.submit(extract_source, source, pages, max_tokens)
+            owners[futures[i]] = threads
+        elif isinstance(source, str) and os.path.splitext(source)[1] in PARSED_EXTENSIONS and os.path.isfile(source):
+            if processes is None:
+                worker = worker_module()
+                processes = ProcessPoolExecutor(max_workers=min(workers, os.cpu_count() or 1), mp_context=process_context(), initializer=worker.init_worker, initargs=(worker_settings(),))
+                pools[processes] = min(workers, os.cpu_count() or 1)
+            futures[i] = processes.submit(worker.extract_source, source, pages, max_tokens)
+            owners[futures[i]] = processes
+    results = {}
+    pending = set(futures.values())
+    started = {}
+    timed_out = set()
+    # Workers held by a source that timed out: a pool with none left can't run its queued sources
+    stuck = dict.fromkeys(pools, 0)
+    try:
+        for i, source in enumerate(sources):
+            if i not in futures:
+                results[i] = extract_source(source, pages, max_tokens)
+        while pending:
+            _, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            now = time.monotonic()
+            for future in list(pending):
+                pool = owners[future]
+                if future.running():
+                    # The timeout of a source counts from the moment a worker picks it up
+                    if now - started.setdefault(future, now) >= timeout:
+                        timed_out.add(future)
+                        pending.discard(future)
+                        stuck[pool] += 1
+                elif stuck[pool] >= pools[pool]:
+                    future.cancel()
+                    pending.discard(future)
+        for i, future in futures.items():
+            if future in timed_out:
+                results[i] = f"Timed out after {timeout} seconds while extracting {sources[i]!r}"
+            elif future.cancelled():
+                results[i] = f"Not extracted: every worker is held by a source that timed out, {sources[i]!r} never ran"
+            else:
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    results[i] = f"Error while extracting {sources[i]!r}: {e}"
+    finally:
+        for executor in pools:
+            # Don't wait for a source that is still hanging
+            executor.shutdown(wait=not timed_out, cancel_futures=True)
+    results = [results[i] for i in range(len(sources))]
+    return results
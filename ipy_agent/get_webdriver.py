@@ -11,6 +11,25 @@ from selenium.webdriver.firefox.service import Service as FirefoxService
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from get_gecko_driver import GetGeckoDriver
 from shutil import which
+from contextlib import contextmanager
+from threading import Lock, Condition
+from functools import lru_cache
+import atexit
+import weakref
+import time
+
+@lru_cache(maxsize=None)
+def geckodriver_path():
+    # Looked up (and installed if missing) once per process
+    path=which('geckodriver')
+    if not path:
+        # Install the latest version of GeckoDriver
+        get_driver = GetGeckoDriver()
+        path=get_driver.install()
+        print(f"geckodriver successfully installed to {path}")
+    else:
+        path=os.path.dirname(path)
+    return os.path.join(path,'geckodriver')
 
 def get_webdriver():
     if os.getenv('ROOT_PATH'):
@@ -21,16 +40,8 @@ def get_webdriver():
     if not os.path.isdir(tmp_path):
         os.makedirs(tmp_path)
     os.environ['TMPDIR']=tmp_path
-    path=which('geckodriver')
-    if not path:
-        # Install the latest version of GeckoDriver
-        get_driver = GetGeckoDriver()
-        path=get_driver.install()
-        print(f"geckodriver successfully installed to {path}")
-    else:
-        path=os.path.dirname(path)
     # Set the driver
-    service=FirefoxService(log_path=os.path.devnull,executable_path=os.path.join(path,'geckodriver'))
+    service=FirefoxService(log_path=os.path.devnull,executable_path=geckodriver_path())
     options = FirefoxOptions()
     # Enable headless mode
     options.add_argument('--headless')
@@ -40,4 +51,187 @@ def get_webdriver():
     options.add_argument('--window-size=1920,1080')
     # Instantiate a headless Firefox WebDriver
     driver = webdriver.Firefox(options=options, service=service)
-    return driver
\ No newline at end of file
+    return driver
+
+class BrowserPool:
+    """
+    Pool of up to size warm headless webdrivers, leased and returned instead of being started for each page.
+    Drivers are health-checked when leased, reset when returned, and recycled after max_pages pages.
+    factory creates a new driver (get_webdriver by default).
+    """
+
+    def __init__(self,size=2,max_pages=50,page_timeout=30,lease_timeout=60,factory=None):
+        self.size=size
+        self.max_pages=max_pages
+        self.page_timeout=page_timeout
+        self.lease_timeout=lease_timeout
+        self.factory=factory or get_webdriver
+        self.idle=[]
+        self.pages={}
+        # Every live driver, idle or leased, by id
+        self.drivers={}
+        self.created=0
+        self.closed=False
+        self.lock=Lock()
+        self.available=Condition(self.lock)
+
+    def create(self):
+        driver=self.factory()
+        if self.page_timeout:
+            driver.set_page_load_timeout(self.page_timeout)
+        return driver
+
+    def warm(self,num=None):
+        """
+        starts drivers until num (default: size) of them are idle
+        """
+        num=min(self.size if num is None else num,self.size)
+        drivers=[]
+        while len(self.idle)+len(drivers)<num and self.created<self.size:
+            drivers.append(self.lease())
+        for driver in drivers:
+            self.release(driver)
+
+    def healthy(self,driver):
+        try:
+            return driver.execute_script("return 1")==1
+        except Exception:
+            return False
+
+    def discard(self,driver):
+        with self.lock:
+            # A driver already quit by close() is not counted twice
+            if self.drivers.pop(id(driver),None) is None:
+                return
+            self.pages.pop(id(driver),None)
+            self.created-=1
+            self.available.notify()
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def lease(self,timeout=None):
+        timeout=self.lease_timeout if timeout is None else timeout
+        deadline=time.monotonic()+timeout
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError("The browser pool is closed.")
+                if self.idle:
+                    driver=self.idle.pop()
+                elif self.created<self.size:
+                    self.created+=1
+                    driver=None
+                else:
+                    remaining=deadline-time.monotonic()
+                    if remaining<=0:
+                        raise TimeoutError(f"No webdriver available after {timeout} seconds.")
+                    self.available.wait(remaining)
+                    continue
+            if driver is None:
+                try:
+                    driver=self.create()
+                except Exception:
+                    with self.lock:
+                        self.created-=1
+                        self.available.notify()
+                    raise
+                with self.lock:
+                    self.pages[id(driver)]=0
+                    self.drivers[id(driver)]=driver
+            elif not self.healthy(driver):
+                self.discard(driver)
+                continue
+            return driver
+
+    def reset(self,driver):
+        try:
+            driver.delete_all_cookies()
+            driver.get('about:blank')
+            return True
+        except Exception:
+            return False
+
+    def release(self,driver):
+        with self.lock:
+            pages=self.pages.get(id(driver),0)+1
+            self.pages[id(driver)]=pages
+        if self.closed or pages>=self.max_pages or not self.reset(driver):
+            self.discard(driver)
+        else:
+            with self.lock:
+                self.idle.append(driver)
+                self.available.notify()
+
+    @contextmanager
+    def session(self,timeout=None):
+        driver=self.lease(timeout=timeout)
+        try:
+            yield driver
+        finally:
+            self.release(driver)
+
+    def stats(self):
+        with self.lock:
+            return dict(size=self.size,created=self.created,idle=len(self.idle),leased=self.created-len(self.idle))
+
+    def close(self):
+        """
+        quits every driver, including the leased ones, so that no browser process outlives the interpreter
+        """
+        with self.lock:
+            self.closed=True
+            self.idle=[]
+            drivers=list(self.drivers.values())
+        for driver in drivers:
+            self.discard(driver)
+
+class PooledDriver:
+    """
+    Webdriver leased from a BrowserPool. quit() returns it to the pool,
+    and so does garbage collection if quit() is never called.
+    """
+
+    def __init__(self,pool,driver):
+        self._driver=driver
+        # Holds the pool and driver, not self, so that a forgotten lease is still released
+        self._release=weakref.finalize(self,pool.release,driver)
+
+    def __getattr__(self,attr):
+        if self._driver is None:
+            raise RuntimeError("This webdriver has been returned to the pool.")
+        return getattr(self._driver,attr)
+
+    def quit(self):
+        if self._driver is not None:
+            self._driver=None
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.quit()
+
+_pools={}
+_pool_lock=Lock()
+
+def browser_pool(name="pages",**kwargs):
+    """
+    returns the shared browser pool of the given name, closed automatically at exit. kwargs update its settings.
+    Page extraction uses the "pages" pool, drivers leased by agent code the "tools" pool, so that one can't starve the other.
+    """
+    with _pool_lock:
+        pool=_pools.get(name)
+        if pool is None or pool.closed:
+            pool=_pools[name]=BrowserPool(**kwargs)
+            atexit.register(pool.close)
+        else:
+            for key,value in kwargs.items():
+                setattr(pool,key,value)
+        return pool
+
+def lease_webdriver(timeout=None):
+    pool=browser_pool("tools")
+    return PooledDriver(pool,pool.lease(timeout=timeout))
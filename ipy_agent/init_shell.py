@@ -2,6 +2,8 @@ from IPython.display import display, Markdown
 from IPython.core.magic import register_line_cell_magic
 from IPython import get_ipython
 import os
+import re
+import time
                         
 def is_notebook():
     try:
@@ -15,22 +17,75 @@ def is_notebook():
     except NameError:
         return False      # Not running in IPython
     
+MD_REPLACEMENTS={"```run_python":"```python",'\\)':'$','\\(':'$','\\[':'$$','\\]':'$$'}
+MD_PATTERN=re.compile('|'.join(re.escape(old) for old in MD_REPLACEMENTS))
+# Number of trailing characters that may hold an incomplete pattern
+MD_HOLDBACK=max(len(old) for old in MD_REPLACEMENTS)-1
+
+def rewrite_md(string):
+    return MD_PATTERN.sub(lambda match: MD_REPLACEMENTS[match.group(0)],string)
+
 class MarkdownOutput:
+    """
+    Streams markdown to a notebook display.
+    Fragments are rewritten incrementally (LaTeX delimiters, run_python fences) as they arrive,
+    and updates of the display are throttled to max_fps, the last one being sent by flush().
+    """
 
-    def __init__(self):
+    def __init__(self,max_fps=20):
         self.current_id=0
-        self.current_content=''
+        self.rendered=''
+        self.pending=''
+        self.dirty=False
+        self.last_flush=0.0
+        self.min_interval=1/max_fps
+        self.flushes=0
+        self.bytes_sent=0
         self.is_notebook=is_notebook()
 
+    @property
+    def current_content(self):
+        return self.rendered+rewrite_md(self.pending)
+
+    def rewrite(self,string):
+        self.pending+=string
+        cut=len(self.pending)-MD_HOLDBACK
+        if cut<=0:
+            return
+        # Never split a pattern straddling the cut
+        for match in MD_PATTERN.finditer(self.pending,max(0,cut-MD_HOLDBACK)):
+            if match.start()<cut<match.end():
+                cut=match.start()
+                break
+        self.rendered+=rewrite_md(self.pending[:cut])
+        self.pending=self.pending[cut:]
+
+    def send(self,update):
+        content=self.current_content
+        display(Markdown(content),display_id=str(self.current_id),update=update)
+        self.flushes+=1
+        self.bytes_sent+=len(content.encode('utf-8'))
+        self.last_flush=time.monotonic()
+        self.dirty=False
+
+    def flush(self):
+        if self.is_notebook and self.dirty:
+            self.send(update=True)
+
     def display(self,string,update=False):
         if self.is_notebook:
             if update:
-                self.current_content+=string
-                display(Markdown(self.current_content.replace("```run_python","```python").replace('\\)','$').replace('\\(','$').replace('\\[','$$').replace('\\]','$$')),display_id=str(self.current_id),update=True)
+                self.rewrite(string)
+                self.dirty=True
+                if time.monotonic()-self.last_flush>=self.min_interval:
+                    self.send(update=True)
             else:
+                self.flush()
                 self.current_id+=1
-                self.current_content=string
-                display(Markdown(self.current_content.replace("```run_python","```python").replace('\\)','$').replace('\\(','$').replace('\\[','$$').replace('\\]','$$')),display_id=str(self.current_id))
+                self.rendered=''
+                self.pending=''
+                self.rewrite(string)
+                self.send(update=False)
         else:
             print(string,end='',flush=True)
 
@@ -39,6 +94,9 @@ _md_output=MarkdownOutput()
 def display_md(string,update=False):
     _md_output.display(string,update)
 
+def flush_md():
+    _md_output.flush()
+
 def new_code_cell(code):
     get_ipython().set_next_input(code)
 
@@ -7,13 +7,21 @@ from functools import wraps
 from .retrieval import DocumentStore
 from .dictation import Dictation
 from .msg_collector import MsgCollector,CollectIO
+from .msg_history import MessageHistory
 from .tools import get_text, init_tools
-from .utils import root_join,Message,text_content,shell_type,truncate,pack_msgs,total_tokens,sort,extract_python,format
+from .get_text import configure_http_cache, configure_page_cache, configure_extraction_cache, get_text_many
+from .utils import root_join,Message,text_content,shell_type,truncate,token_count,pack_msgs,extract_python,format,run_sync,TRUNCATION_MARKER_TOKENS
 from .voice import VoiceProcessor
 from textwrap import dedent
 from dotenv import load_dotenv
+from heapq import merge
+from contextlib import contextmanager
+import asyncio
 import os
 
+def new_prefix_stats():
+    return AttrDict(turns=0, stable_tokens=0, total_tokens=0, last_stable_tokens=0, last_total_tokens=0)
+
 class IPyAgent:
 
     default_config = AttrDict(
@@ -24,14 +32,20 @@ class IPyAgent:
         top_p=1,
         language='fr',
         voice_enabled=True,
-        voice="shimmer"
+        voice="shimmer",
+        context_layout="timeline"
     )
 
     def __init__(self, name=None, username=None, preprompt=None, workfolder=None, shell=None, **kwargs):
         self.client = LLMClient()
         self.config = IPyAgent.default_config
         self.config.update(**kwargs)
-        self.messages = []
+        self.history = MessageHistory()
+        # Last rendering of each header, reused (with its cached token count) while its content doesn't change
+        self.rendered_headers = {}
+        # Messages sent in the previous turn, to measure how much of the prompt prefix is reused
+        self.last_context = []
+        self.prefix_stats = new_prefix_stats()
         self.collector = MsgCollector(self)
         self.name = name or "Agent"
         self.capture=True
@@ -43,7 +57,7 @@ class IPyAgent:
         self.add_message(Message(content=preprompt or text_content(root_join("default_preprompt.txt")), role="system", name="Instructions", type="header"))
         self.init_files()
         self.voice=VoiceProcessor(self)
-        self.store=DocumentStore(folder=os.path.join(self.workfolder,"documents"))
+        self.store=DocumentStore(folder=os.path.join(self.workfolder,"documents"),cache_file=os.path.join(self.workfolder,"embeddings_cache.db"))
         self.init_shell(shell=shell)
         self.init_memory()
         self.init_tools()
@@ -65,6 +79,9 @@ class IPyAgent:
         path=os.path.join(self.workfolder,"documents")
         if not os.path.isdir(path):
             os.makedirs(path)
+        configure_http_cache(os.path.join(self.workfolder,"http_cache"))
+        configure_page_cache(os.path.join(self.workfolder,"pdf_pages"))
+        self.extraction_cache=configure_extraction_cache(os.path.join(self.workfolder,"extraction_cache.db"))
 
     def init_files(self):
         path=os.path.join(self.workfolder,".env")
@@ -160,7 +177,16 @@ class IPyAgent:
         init_tools(self)
         
     def observe(self,data,lasting=3):
-        text=get_text(data)
+        if isinstance(data,list):
+            # Sources are extracted in parallel, and observed as a single message:
+            # each one is truncated to its share of max_tokens, so that none drops out of the message's truncation
+            headers=[f"Source: {source if isinstance(source,str) else repr(source)[:100]}" for source in data]
+            share=max(1,(self.config.max_tokens-token_count('\n\n'.join(headers)))//max(1,len(data))-TRUNCATION_MARKER_TOKENS)
+            texts=get_text_many(data,max_tokens=share)
+            text='\n\n'.join(f"{header}\n{truncate(text,max_tokens=share)}" for header,text in zip(headers,texts))
+        else:
+            # Large PDFs are only extracted as far as the message can hold
+            text=get_text(data,max_tokens=self.config.max_tokens)
         self.collector.collect(Message(content=text,role="system",name="Observation",type='temp',lasting=lasting))
         self.new_turn=True
 
@@ -168,67 +194,101 @@ class IPyAgent:
         msg.content = truncate(msg.content.strip(), max_tokens=self.config.max_tokens)
         if msg.role == "assistant":
             msg.content += "\n#SUBMIT#"
-        self.messages.append(msg)
+        self.history.add(msg)
 
     def add_tool(self, name, obj, description,no_add=False):
         self.tools.update({name:obj})
         self.add_message(Message(content=description, role="system", name="Tool", type="header"))
 
+    @property
+    def messages(self):
+        return self.history.get()
+
     def get_messages(self, type="all"):
-        if type == "all":
-            return self.messages
-        else:
-            return [msg for msg in self.messages if msg.type == type]
+        return self.history.get(type)
         
-    def get_retrieved(self):
-        query=pack_msgs(self.get_messages(type="queued")[-2:])
-        results=self.store.search(query,num=15,threshold=0.4)
+    def retrieval_query(self):
+        return pack_msgs(self.history.queued[-2:])
+
+    def search_retrieved(self,query):
+        return self.store.search(query,num=15,threshold=0.4)
+
+    def get_retrieved(self,results=None):
+        if results is None:
+            results=self.search_retrieved(self.retrieval_query())
         if results:
             return [Message(content=f"Document Store's current auto-retrieval results:\n {repr(results)}",role="system",name="Retrieval",type='temp',lasting=1)]
         else:
             return []
 
     def reduce_lasting(self):
-        msgs=[]
-        for msg in self.messages:
-            if msg.lasting==0:
-                msgs.append(msg)
-            elif msg.lasting==1:
-                pass
-            else:
-                msg.lasting-=1
-                msgs.append(msg)
-        self.messages = msgs
-
-    def gen_context(self):
-        headers=[Message(content=format(header.content,context={'self':self,'agent':self,**globals()}),role=header.role,name=header.name,type=header.type) for header in self.get_messages(type="header")]
-        queued = self.get_messages(type="queued")
+        self.history.reduce_lasting()
+
+    def render_header(self, header):
+        if '<<<' not in header.content:
+            return header
+        content = format(header.content, context={'self':self,'agent':self,**globals()})
+        rendered = self.rendered_headers.get(id(header))
+        if rendered is None or rendered.content != content:
+            rendered = Message(content=content, role=header.role, name=header.name, type=header.type)
+            self.rendered_headers[id(header)] = rendered
+        return rendered
+
+    def gen_context(self,retrieval=None):
+        headers=[self.render_header(header) for header in self.get_messages(type="header")]
         temp=self.get_messages(type="temp")
-        retrieved=self.get_retrieved()
+        retrieved=self.get_retrieved(retrieval)
 
-        current_count = total_tokens(headers + temp + retrieved)
+        current_count = sum(msg.tokens for msg in headers + temp + retrieved)
         context_limit = self.config.token_limit - self.config.max_tokens
         available_tokens = context_limit - current_count
 
-        recent = []
-        tokens = 0
-
-        for msg in reversed(queued):
-            msg_tokens = total_tokens([msg])
-            if tokens + msg_tokens <= available_tokens:
-                tokens += msg_tokens
-                recent.append(msg)
-            else:
-                break
-        context = headers + sort(temp + recent + retrieved)
+        if self.config.context_layout == "stable":
+            # Byte-stable prefix (headers, then the conversation) followed by the volatile parts
+            recent = self.history.stable_queued(available_tokens)
+            context = headers + recent + list(merge(temp, retrieved, key=lambda msg: msg.seq))
+        else:
+            recent = self.history.recent_queued(available_tokens)
+            # Each part is already in sequence order
+            context = headers + list(merge(temp, recent, retrieved, key=lambda msg: msg.seq))
+        self.track_prefix(context)
         self.reduce_lasting()
         return context
 
-    def stream_response(self):
-        self.collector.dump_message()
+    def track_prefix(self, context):
+        api_dicts = [msg.to_api_dict() for msg in context]
+        stable_tokens = 0
+        for msg, api_dict, previous in zip(context, api_dicts, self.last_context):
+            if api_dict != previous:
+                break
+            stable_tokens += msg.tokens
+        total_tokens = sum(msg.tokens for msg in context)
+        self.last_context = api_dicts
+        stats = self.prefix_stats
+        stats.turns += 1
+        stats.stable_tokens += stable_tokens
+        stats.total_tokens += total_tokens
+        stats.last_stable_tokens = stable_tokens
+        stats.last_total_tokens = total_tokens
+
+    def prefix_stability(self):
+        """
+        reports how many prompt tokens were identical to the previous turn's prompt prefix, last turn and overall
+        """
+        stats = self.prefix_stats
+        return dict(
+            layout=self.config.context_layout,
+            **stats,
+            last_ratio=stats.last_stable_tokens / stats.last_total_tokens if stats.last_total_tokens else 0.0,
+            ratio=stats.stable_tokens / stats.total_tokens if stats.total_tokens else 0.0
+        )
 
-        params = dict(
-            messages=self.gen_context(),
+    def completion_params(self,retrieval=None):
+        """
+        retrieval optionally holds the results of the auto-retrieval search, when already done (see acall)
+        """
+        return dict(
+            messages=self.gen_context(retrieval),
             model=self.config.model,
             temperature=self.config.temperature,
             top_p=self.config.top_p,
@@ -236,6 +296,11 @@ class IPyAgent:
             stop=["#SUBMIT#"]
         )
 
+    def stream_response(self):
+        self.collector.dump_message()
+
+        params = self.completion_params()
+
         self.capture=False
         for token in self.voice.speak(self.client.streamed_completion(**params)):
             self.collector.collect(Message(content=token,role="assistant",name=self.name,type="queued"))
@@ -252,6 +317,9 @@ class IPyAgent:
     def display_md(self,string,update=False):
         self.shell.user_ns['display_md'](string,update)
 
+    def flush_md(self):
+        self.shell.user_ns['flush_md']()
+
     def new_code_cell(self,code):
         self.shell.user_ns['new_code_cell'](code)
 
@@ -260,7 +328,7 @@ class IPyAgent:
 
         self.stream_response()
 
-        python_parts = extract_python(self.messages[-1].content)
+        python_parts = extract_python(self.history.last.content)
         if python_parts:
             self.new_turn = True
             for code in python_parts:
@@ -283,6 +351,87 @@ class IPyAgent:
         self.silent=False
         return self.data_output
 
+    def new_call_state(self, **kwargs):
+        """
+        returns a fresh per-call state, sharing only the agent's headers
+        """
+        history = MessageHistory()
+        for header in self.history.get("header"):
+            history.add(header)
+        return dict(
+            history=history,
+            collector=MsgCollector(self),
+            data_output=None,
+            silent=True,
+            call_kwargs=AttrDict(**kwargs),
+            new_turn=False,
+            last_context=[],
+            prefix_stats=new_prefix_stats(),
+            current_role="assistant",
+            current_name=self.name
+        )
+
+    @contextmanager
+    def isolated(self, state):
+        """
+        swaps the agent's per-call state with the given one for the duration of the context
+        """
+        saved = {attr: self.__dict__.get(attr) for attr in state}
+        self.__dict__.update(state)
+        try:
+            yield
+        finally:
+            for attr in state:
+                state[attr] = self.__dict__[attr]
+            self.__dict__.update(saved)
+
+    async def acall(self, prompt, **kwargs):
+        """
+        async and silent counterpart of __call__, run with its own message history.
+        The completions and the auto-retrieval searches are awaited: code execution in the shell stays synchronous, so concurrent calls never interleave there.
+        The call keeps its own prefix stability stats, leaving the agent's ones untouched.
+        """
+        state = self.new_call_state(**kwargs)
+        with self.isolated(state):
+            self.collector.collect(Message(content=prompt, role="user", name=self.username, type="queued"))
+            self.collector.dump_message()
+            self.new_turn = True
+        while state['new_turn']:
+            # The retrieval search embeds the query (a blocking request): it runs in a thread, off the event loop
+            with self.isolated(state):
+                query = self.retrieval_query()
+            retrieval = await asyncio.to_thread(self.search_retrieved, query)
+            with self.isolated(state):
+                params = self.completion_params(retrieval)
+            content = await self.client.acompletion(**params)
+            with self.isolated(state):
+                self.new_turn = False
+                self.collector.collect(Message(content=content + '\n', role="assistant", name=self.name, type="queued"))
+                self.collector.dump_message()
+                python_parts = extract_python(self.history.last.content)
+                for code in python_parts:
+                    self.new_turn = True
+                    self.run_agent_code(code)
+                self.collector.dump_message()
+        return state['data_output']
+
+    async def amap(self, prompts, concurrency=4, **kwargs):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(prompt):
+            async with semaphore:
+                return await self.acall(prompt, **kwargs)
+
+        async with self.client.session(max_connections=concurrency):
+            return await asyncio.gather(*(run(prompt) for prompt in prompts))
+
+    def map(self, prompts, concurrency=4, **kwargs):
+        """
+        runs independent agent calls on a list of prompts, up to concurrency at a time,
+        and returns the data output of each call in order
+        """
+        return run_sync(self.amap(prompts, concurrency=concurrency, **kwargs))
+
     def interact(self):
         self.shell.mainloop()
 
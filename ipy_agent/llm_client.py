@@ -1,6 +1,56 @@
 import litellm
+from contextlib import asynccontextmanager
+import asyncio
+import time
+import re
 import os
 
+class MockProvider:
+
+    """
+    Local stand-in for an LLM provider, used for models named 'mock/<anything>'.
+    Replies after a fixed latency, streaming the reply word by word.
+    response may be a string or a function of the prepared messages (defaults to echoing the last message).
+    """
+
+    def __init__(self,response=None,latency=0.5,token_delay=0.0):
+        self.response=response
+        self.latency=latency
+        self.token_delay=token_delay
+        self.calls=0
+
+    def reply(self,messages):
+        self.calls+=1
+        if callable(self.response):
+            return self.response(messages)
+        elif self.response is not None:
+            return self.response
+        else:
+            return f"Echo: {messages[-1]['content']}"
+
+    def tokens(self,text):
+        return re.findall(r'\S+\s*|\s+',text)
+
+    def completion(self,messages,**kwargs):
+        time.sleep(self.latency)
+        return self.reply(messages)
+
+    def stream(self,messages,**kwargs):
+        time.sleep(self.latency)
+        for token in self.tokens(self.reply(messages)):
+            time.sleep(self.token_delay)
+            yield token
+
+    async def acompletion(self,messages,**kwargs):
+        await asyncio.sleep(self.latency)
+        return self.reply(messages)
+
+    async def astream(self,messages,**kwargs):
+        await asyncio.sleep(self.latency)
+        for token in self.tokens(self.reply(messages)):
+            await asyncio.sleep(self.token_delay)
+            yield token
+
 class LLMClient:
 
     """
@@ -8,9 +58,10 @@ class LLMClient:
     API keys can be provided either by a dict or via env variables
     """
 
-    def __init__(self,model=None,api_keys=None):
+    def __init__(self,model=None,api_keys=None,mock=None):
         self.api_keys=api_keys or {}
         self.model=model
+        self.mock=mock or MockProvider()
         self.init_api_keys()
 
     def init_api_keys(self,api_keys=None):
@@ -18,19 +69,60 @@ class LLMClient:
             for key,secret in api_keys.items():
                 os.environ[key]=secret
 
+    def is_mock(self,model):
+        return model.startswith('mock/')
+
     def chat_completion(self,model=None,**kwargs):
         model=model or self.model
         kwargs.update(model=model,messages=self.prepare_messages(kwargs['messages']))
+        if self.is_mock(model):
+            return self.mock.completion(**kwargs)
         response=litellm.completion(**kwargs)
         return response.choices[0].message.content
-        
+
     def streamed_completion(self,model=None,**kwargs):
         model=model or self.model
         kwargs.update(model=model,messages=self.prepare_messages(kwargs['messages']),stream=True)
+        if self.is_mock(model):
+            yield from self.mock.stream(**kwargs)
+            return
         response=litellm.completion(**kwargs)
         for part in response:
             yield part.choices[0].delta.content or ""
-        
+
+    async def acompletion(self,model=None,**kwargs):
+        model=model or self.model
+        kwargs.update(model=model,messages=self.prepare_messages(kwargs['messages']))
+        if self.is_mock(model):
+            return await self.mock.acompletion(**kwargs)
+        response=await litellm.acompletion(**kwargs)
+        return response.choices[0].message.content
+
+    async def astream(self,model=None,**kwargs):
+        model=model or self.model
+        kwargs.update(model=model,messages=self.prepare_messages(kwargs['messages']),stream=True)
+        if self.is_mock(model):
+            async for token in self.mock.astream(**kwargs):
+                yield token
+            return
+        response=await litellm.acompletion(**kwargs)
+        async for part in response:
+            yield part.choices[0].delta.content or ""
+
+    @asynccontextmanager
+    async def session(self,max_connections=100):
+        """
+        shares a single pool of keep-alive HTTP connections among the async calls made within the context
+        """
+        import httpx
+        saved=litellm.aclient_session
+        litellm.aclient_session=httpx.AsyncClient(limits=httpx.Limits(max_connections=max_connections,max_keepalive_connections=max_connections))
+        try:
+            yield self
+        finally:
+            await litellm.aclient_session.aclose()
+            litellm.aclient_session=saved
+
     def prepare_messages(self,messages):
-        prepared=[dict(content=msg.content,role=msg.role,name=msg.name) for msg in messages]
+        prepared=[msg.to_api_dict() for msg in messages]
         return prepared
@@ -1,12 +1,64 @@
 from .utils import Message
+from collections import deque
 import sys
 
 class MsgCollector:
+    """
+    Coalesces consecutive fragments from the same source into a single message.
+    Fragments are buffered and joined only when the message is dumped to the agent's history.
+    Only the first and last max_chars/2 characters are retained (by default 8 chars per token of the agent's max_tokens),
+    so that a very chatty output uses bounded memory while the agent still sees its start and end.
+    """
 
-    def __init__(self, agent):
+    def __init__(self, agent, max_chars=None):
         self.agent = agent
         self.current_message = None
         self.id=0
+        self.max_chars=max_chars
+        self.reset_buffer()
+
+    @property
+    def half_cap(self):
+        return (self.max_chars or 8*self.agent.config.max_tokens)//2
+
+    def reset_buffer(self):
+        self.head=[]
+        self.head_size=0
+        self.tail=deque()
+        self.tail_size=0
+        self.dropped=0
+
+    def write(self, data):
+        half=self.half_cap
+        room=half-self.head_size
+        if room>0:
+            self.head.append(data[:room])
+            self.head_size+=len(self.head[-1])
+            data=data[room:]
+        if not data:
+            return
+        if len(data)>=half:
+            self.dropped+=self.tail_size+len(data)-half
+            self.tail=deque([data[-half:]])
+            self.tail_size=half
+            return
+        self.tail.append(data)
+        self.tail_size+=len(data)
+        # Drop the oldest fragments as long as the remaining ones still fill the tail
+        while self.tail_size-len(self.tail[0])>=half:
+            self.dropped+=len(self.tail[0])
+            self.tail_size-=len(self.tail.popleft())
+
+    def buffered_content(self):
+        head=''.join(self.head)
+        tail=''.join(self.tail)
+        excess=len(tail)-self.half_cap
+        if excess>0:
+            tail=tail[excess:]
+            self.dropped+=excess
+        if self.dropped:
+            return head+f"\n\n#####\n\n[Output too long: {self.dropped} characters dropped]\n\n#####\n\n"+tail
+        return head+tail
 
     def collect(self, msg):
         if msg.role=='user':
@@ -14,15 +66,20 @@ class MsgCollector:
         if self.current_message is None or msg.name != self.current_message.name:
             self.dump_message()
             self.current_message = msg
+            self.write(msg.content)
             if msg.role=='assistant' and not self.agent.silent:
                 self.agent.display_md(msg.content)
         else:
-            self.current_message.content += msg.content
+            self.write(msg.content)
             if msg.role=='assistant' and not self.agent.silent:
                 self.agent.display_md(msg.content,update=True)
 
     def dump_message(self):
         if self.current_message:
+            self.current_message.content = self.buffered_content()
+            self.reset_buffer()
+            if self.current_message.role=='assistant' and not self.agent.silent:
+                self.agent.flush_md()
             self.agent.add_message(self.current_message)
             self.current_message = None
 
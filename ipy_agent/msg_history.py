@@ -0,0 +1,74 @@
+from bisect import bisect_left
+from heapq import heappush, heappop, merge
+
+class MessageHistory:
+    """
+    Message history of the agent, indexed by message type.
+    Each type (header, queued, temp...) has its own store kept in sequence order,
+    expiring messages (lasting>0) are tracked in a min-heap of expiry turns,
+    and queued messages carry the prefix sums of their token counts to select a context window by bisection.
+    Per-turn bookkeeping only touches the messages that are added or expire.
+    """
+
+    def __init__(self):
+        self.stores = {}
+        self.queued = []
+        self.queued_tokens = [0]
+        self.queued_seqs = []
+        self.window_seq = 0
+        self.expiring = []
+        self.turn = 0
+        self.last = None
+
+    def add(self, msg):
+        self.stores.setdefault(msg.type, {})[msg.seq] = msg
+        if msg.type == "queued":
+            self.queued.append(msg)
+            self.queued_seqs.append(msg.seq)
+            self.queued_tokens.append(self.queued_tokens[-1] + msg.tokens)
+        if msg.lasting:
+            # A message lasting n turns is dropped by the n-th call to reduce_lasting
+            heappush(self.expiring, (self.turn + msg.lasting, msg.seq, msg))
+        self.last = msg
+
+    def get(self, type="all"):
+        if type == "all":
+            return list(merge(*(store.values() for store in self.stores.values()), key=lambda msg: msg.seq))
+        return list(self.stores.get(type, {}).values())
+
+    def __len__(self):
+        return sum(len(store) for store in self.stores.values())
+
+    def reduce_lasting(self):
+        self.turn += 1
+        rebuild = False
+        while self.expiring and self.expiring[0][0] <= self.turn:
+            _, seq, msg = heappop(self.expiring)
+            self.stores[msg.type].pop(seq, None)
+            rebuild = rebuild or msg.type == "queued"
+        if rebuild:
+            self.queued = list(self.stores["queued"].values())
+            self.queued_seqs = [msg.seq for msg in self.queued]
+            self.queued_tokens = [0]
+            for msg in self.queued:
+                self.queued_tokens.append(self.queued_tokens[-1] + msg.tokens)
+
+    def recent_queued(self, available_tokens):
+        """
+        returns the longest run of most recent queued messages fitting in available_tokens
+        """
+        start = bisect_left(self.queued_tokens, self.queued_tokens[-1] - available_tokens)
+        return self.queued[min(start, len(self.queued)):]
+
+    def stable_queued(self, available_tokens, slack=0.25):
+        """
+        like recent_queued, but the first message of the window only moves when the window overflows,
+        and then leaves slack*available_tokens free, so that the window keeps the same start over many turns
+        """
+        start = min(bisect_left(self.queued_tokens, self.queued_tokens[-1] - available_tokens), len(self.queued))
+        first = bisect_left(self.queued_seqs, self.window_seq)
+        if first < start:
+            first = bisect_left(self.queued_tokens, self.queued_tokens[-1] - int(available_tokens * (1 - slack)))
+            first = min(max(first, start), len(self.queued))
+            self.window_seq = self.queued_seqs[first] if first < len(self.queued) else self.queued_seqs[-1] + 1
+        return self.queued[first:]
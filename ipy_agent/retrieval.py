@@ -2,64 +2,403 @@ from openai import OpenAI
 import numpy as np
 import json
 import os
-from .utils import token_count
+import time
+import random
+import re
+from itertools import chain
+from threading import Lock, RLock
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .utils import token_count, token_count_many
+from .embedding_cache import EmbeddingCache
+
+# Version of the on-disk document layout:
+# <title>.json holds the metadata, the row order of the embedding matrix and the generation N of the snapshot files:
+# the matrix is stored in <title>.N.npy, <title>.N.entries holds one json line per row (content key and entry: strings, values...),
+# whose byte offsets are stored in <title>.N.offsets.npy for random access.
+# Snapshot files are never overwritten: a new generation is written aside and committed by replacing the json file.
+# Format 3 used unsuffixed snapshot files (generation 0), format 2 kept the entries inside the json file,
+# files without a 'format' field use the legacy layout (embeddings inlined as json lists).
+FORMAT_VERSION=4
+
+# Rough per-entry memory overhead (dicts, keys, index bookkeeping) used to estimate a document's resident size
+ENTRY_OVERHEAD=400
+
+# Per-request limits of the embeddings endpoint (kept slightly below the documented ones)
+MAX_BATCH_ITEMS=2048
+MAX_BATCH_TOKENS=250000
 
 def normalize(vect,precision=5):
     inv_norm=1.0/np.linalg.norm(vect,ord=2)
     return [round(x_i*(inv_norm),precision) for x_i in vect]
 
+def top_k(scores,num=10,threshold=0.25):
+    """
+    returns the indices of the num highest scores above threshold, sorted by decreasing score
+    """
+    candidates=np.flatnonzero(scores>=threshold)
+    if len(candidates)>num:
+        candidates=candidates[np.argpartition(scores[candidates],-num)[-num:]]
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+class EmbeddingIndex:
+    """
+    Exact (flat) index.
+    Contiguous float32 matrix holding the embeddings of a document, with a parallel row -> key index.
+    Rows are appended in amortized O(1) and deleted by swapping the last row in.
+    """
+
+    type='flat'
+
+    def __init__(self,dimensions):
+        self.dimensions=dimensions
+        self.matrix=np.zeros((16,dimensions),dtype=np.float32)
+        self.keys=[]
+        self.rows={}
+
+    @property
+    def settings(self):
+        return dict(type=self.type)
+
+    def load_matrix(self,matrix,keys):
+        """
+        wraps an existing (possibly read-only memory-mapped) matrix, copied only on first write
+        """
+        self.matrix=matrix
+        self.keys=list(keys)
+        self.rows={key:row for row,key in enumerate(self.keys)}
+
+    def load_state(self,file):
+        pass
+
+    def dump_state(self,file):
+        pass
+
+    def ensure_writable(self):
+        if not self.matrix.flags.writeable:
+            self.matrix=np.array(self.matrix,dtype=np.float32)
+
+    @property
+    def values(self):
+        return self.matrix[:len(self.keys)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self,key):
+        return key in self.rows
+
+    def add(self,key,embedding):
+        self.ensure_writable()
+        if key in self.rows:
+            self.matrix[self.rows[key]]=embedding
+            return
+        n=len(self.keys)
+        if n==len(self.matrix):
+            matrix=np.zeros((max(2*n,16),self.dimensions),dtype=np.float32)
+            matrix[:n]=self.matrix
+            self.matrix=matrix
+        self.matrix[n]=embedding
+        self.rows[key]=n
+        self.keys.append(key)
+
+    def remove(self,key):
+        row=self.rows.pop(key,None)
+        if row is None:
+            return
+        last=len(self.keys)-1
+        if row!=last:
+            self.ensure_writable()
+            moved=self.keys[last]
+            self.matrix[row]=self.matrix[last]
+            self.keys[row]=moved
+            self.rows[moved]=row
+        self.keys.pop()
+
+    def scores(self,vect,keys=None):
+        vect=np.asarray(vect,dtype=np.float32)
+        if keys is None:
+            return self.values @ vect
+        rows=np.fromiter((self.rows[key] for key in keys),dtype=np.intp)
+        return self.matrix[rows] @ vect
+
+    def search(self,vect,num=10,threshold=0.25,keys=None):
+        """
+        returns a list of (key,score) pairs for the best matching rows, optionally restricted to a subset of keys
+        """
+        if keys is not None:
+            keys=list(keys)
+        scores=self.scores(vect,keys)
+        keys=self.keys if keys is None else keys
+        return [(keys[i],float(scores[i])) for i in top_k(scores,num,threshold)]
+
+    def recall(self,vects,k=10):
+        """
+        recall@k of this index's search against the exact scan, averaged over a set of query vectors
+        """
+        found=0
+        expected=0
+        for vect in vects:
+            exact={key for key,_ in EmbeddingIndex.search(self,vect,num=k,threshold=-1)}
+            approx={key for key,_ in self.search(vect,num=k,threshold=-1)}
+            found+=len(exact & approx)
+            expected+=len(exact)
+        return found/expected if expected else 1.0
+
+class IVFIndex(EmbeddingIndex):
+    """
+    Approximate index (inverted file).
+    Rows are bucketed by their nearest centroid of a spherical k-means coarse quantizer,
+    and only the rows of the nprobe closest buckets are scored at query time.
+    The quantizer is trained lazily once the document holds enough rows, and retrained when it has grown much larger since.
+    Until then searches fall back to the exact scan.
+    """
+
+    type='ivf'
+
+    def __init__(self,dimensions,nlist=64,nprobe=8):
+        EmbeddingIndex.__init__(self,dimensions)
+        self.nlist=nlist
+        self.nprobe=nprobe
+        self.centroids=None
+        self.trained_size=0
+        self.assign={}
+        self.buckets=[]
+
+    @property
+    def settings(self):
+        return dict(type=self.type,nlist=self.nlist,nprobe=self.nprobe)
+
+    @property
+    def needs_training(self):
+        if self.centroids is None:
+            return len(self)>=32*self.nlist
+        return len(self)>4*self.trained_size
+
+    def load_matrix(self,matrix,keys):
+        EmbeddingIndex.load_matrix(self,matrix,keys)
+        self.centroids=None
+
+    def load_state(self,file):
+        if os.path.isfile(file):
+            state=np.load(file)
+            if len(state['labels'])==len(self):
+                self.set_centroids(state['centroids'],state['labels'])
+                self.trained_size=int(state['trained_size'])
+
+    def dump_state(self,file):
+        if self.centroids is not None:
+            labels=np.array([self.assign[row] for row in range(len(self))],dtype=np.int32)
+            with open(file+'.tmp','wb') as f:
+                np.savez(f,centroids=self.centroids,labels=labels,trained_size=self.trained_size)
+            os.replace(file+'.tmp',file)
+
+    def train(self,iterations=10):
+        data=self.values
+        k=min(self.nlist,len(data))
+        rng=np.random.default_rng(0)
+        centroids=np.array(data[rng.choice(len(data),k,replace=False)])
+        for _ in range(iterations):
+            labels=np.argmax(data @ centroids.T,axis=1)
+            sums=np.zeros_like(centroids)
+            np.add.at(sums,labels,data)
+            norms=np.linalg.norm(sums,axis=1)
+            nonempty=norms>0
+            centroids[nonempty]=sums[nonempty]/norms[nonempty,None]
+        self.set_centroids(centroids)
+        self.trained_size=len(data)
+
+    def set_centroids(self,centroids,labels=None):
+        self.centroids=np.asarray(centroids,dtype=np.float32)
+        if labels is None:
+            labels=np.argmax(self.values @ self.centroids.T,axis=1)
+        self.assign=dict(enumerate(labels.tolist()))
+        self.buckets=[set() for _ in range(len(self.centroids))]
+        for row,bucket in self.assign.items():
+            self.buckets[bucket].add(row)
+
+    def assign_row(self,row):
+        if row in self.assign:
+            self.buckets[self.assign[row]].discard(row)
+        bucket=int(np.argmax(self.centroids @ self.matrix[row]))
+        self.assign[row]=bucket
+        self.buckets[bucket].add(row)
+
+    def add(self,key,embedding):
+        EmbeddingIndex.add(self,key,embedding)
+        if self.centroids is not None:
+            self.assign_row(self.rows[key])
+
+    def remove(self,key):
+        row=self.rows.get(key)
+        if row is None:
+            return
+        last=len(self)-1
+        EmbeddingIndex.remove(self,key)
+        if self.centroids is not None:
+            self.buckets[self.assign.pop(row)].discard(row)
+            if row!=last:
+                # Mirror the swap of the last row into the freed slot
+                bucket=self.assign.pop(last)
+                self.buckets[bucket].discard(last)
+                self.buckets[bucket].add(row)
+                self.assign[row]=bucket
+
+    def search(self,vect,num=10,threshold=0.25,keys=None):
+        if self.needs_training:
+            self.train()
+        if keys is not None or self.centroids is None:
+            return EmbeddingIndex.search(self,vect,num=num,threshold=threshold,keys=keys)
+        vect=np.asarray(vect,dtype=np.float32)
+        probe=np.argsort(self.centroids @ vect)[::-1][:self.nprobe]
+        rows=np.fromiter(chain.from_iterable(self.buckets[bucket] for bucket in probe),dtype=np.intp)
+        scores=self.matrix[rows] @ vect
+        return [(self.keys[rows[i]],float(scores[i])) for i in top_k(scores,num,threshold)]
+
+INDEX_TYPES=dict(flat=EmbeddingIndex,ivf=IVFIndex)
+
+def make_index(dimensions,settings=None):
+    settings=dict(settings or dict(type='flat'))
+    return INDEX_TYPES[settings.pop('type')](dimensions,**settings)
+
+def make_batches(strings,max_items=MAX_BATCH_ITEMS,max_tokens=MAX_BATCH_TOKENS):
+    """
+    groups strings into consecutive batches respecting both an item limit and a token limit
+    """
+    batches=[]
+    batch=[]
+    tokens=0
+    for string in strings:
+        count=token_count(string)
+        if batch and (len(batch)>=max_items or tokens+count>max_tokens):
+            batches.append(batch)
+            batch=[]
+            tokens=0
+        batch.append(string)
+        tokens+=count
+    if batch:
+        batches.append(batch)
+    return batches
+
 def split_string(string, delimiters):
     """
-    splits a string according to a chosen set of delimiters
+    splits a string according to a chosen set of delimiters (kept at the end of each substring)
     """
-    substrings = []
-    current_substring = ""
-    i = 0
-    while i < len(string):
-        for delimiter in delimiters:
-            if string[i:].startswith(delimiter):
-                current_substring += delimiter
-                if current_substring:
-                    substrings.append(current_substring)
-                    current_substring = ""
-                i += len(delimiter)
-                break
-        else:
-            current_substring += string[i]
-            i += 1
-    if current_substring:
-        substrings.append(current_substring)
-    return substrings
+    pattern = re.compile('|'.join(re.escape(delimiter) for delimiter in delimiters))
+    return [string[start:end] for start, end in split_spans(string, pattern)]
 
-def split_text(text, max_tokens):
+def split_spans(string, pattern):
     """
-    split a text into chunks of maximal token length, not breaking sentences in halves.
+    yields the (start, end) spans of the substrings of a string ending with a match of a compiled pattern, in one linear pass
     """
-    # Tokenize the text into sentences
-    sentences = split_string(text,delimiters=["\n",". ", "! ", "? ", "... ", ": ", "; "])
-    
-    chunks = []
-    current_chunk = ""
+    start = 0
+    for match in pattern.finditer(string):
+        if match.end() > start:
+            yield start, match.end()
+            start = match.end()
+    if start < len(string):
+        yield start, len(string)
+
+SENTENCE_DELIMITERS=["\n",". ", "! ", "? ", "... ", ": ", "; "]
+SENTENCE_PATTERN=re.compile('|'.join(re.escape(delimiter) for delimiter in SENTENCE_DELIMITERS))
+
+# Longest incomplete sentence carried over from one block to the next before being emitted as is
+MAX_CARRY=100000
+
+# Number of sentences tokenized together by the chunker
+TOKENIZE_BATCH=1024
+
+def read_blocks(file,block_size=65536):
+    """
+    reads a text file as a stream of blocks
+    """
+    with open(file,encoding='utf-8',errors='replace') as f:
+        while block:=f.read(block_size):
+            yield block
+
+def ends_sentence(string):
+    return any(string.endswith(delimiter) for delimiter in SENTENCE_DELIMITERS)
+
+def text_sentences(text):
+    """
+    yields the (offset, sentence) pairs of a text
+    """
+    for start, end in split_spans(text, SENTENCE_PATTERN):
+        yield start, text[start:end]
+
+def stream_sentences(blocks):
+    """
+    yields the (offset, sentence) pairs of a stream of text blocks, offsets being relative to the whole stream.
+    The trailing incomplete sentence of a block is carried over to the next one.
+    """
+    carry = ""
+    offset = 0
+    for block in blocks:
+        text = carry + block
+        sentences = list(text_sentences(text))
+        carry = ""
+        if sentences and not ends_sentence(sentences[-1][1]) and len(sentences[-1][1])<=MAX_CARRY:
+            carry = sentences.pop()[1]
+        for start, sentence in sentences:
+            yield offset+start, sentence
+        offset += len(text)-len(carry)
+    if carry:
+        yield offset, carry
+
+def chunk_sentences(sentences, max_tokens, overlap=0):
+    """
+    groups a stream of (offset, sentence) pairs into chunks of maximal token length, not breaking sentences in halves.
+    Consecutive chunks share up to `overlap` tokens worth of trailing sentences.
+    Yields (start, end, chunk) triples as soon as chunks are complete, where start/end are the exact character offsets of the stripped chunk.
+    """
+    current = []
     current_token_count = 0
-    
-    for sentence in sentences:
-        sentence_token_count = token_count(sentence)
-        
-        # If adding the next sentence exceeds the max_tokens limit,
-        # save the current chunk and start a new one
-        if current_token_count + sentence_token_count > max_tokens:
-            chunks.append(current_chunk.strip())
-            current_chunk = ""
-            current_token_count = 0
-        
-        current_chunk += sentence
-        current_token_count += sentence_token_count
-    
-    # Add the remaining chunk if it's not empty
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
-    
-    return chunks
+
+    def emit(current):
+        text = ''.join(sentence for _, sentence, _ in current)
+        stripped = text.strip()
+        if stripped:
+            start = current[0][0] + len(text) - len(text.lstrip())
+            return start, start + len(stripped), stripped
+
+    def tail(current):
+        # Trailing sentences kept as overlap for the next chunk
+        kept = []
+        count = 0
+        for item in reversed(current[1:]):
+            if count + item[2] > overlap:
+                break
+            kept.insert(0, item)
+            count += item[2]
+        return kept, count
+
+    iterator = iter(sentences)
+    while batch := [item for _, item in zip(range(TOKENIZE_BATCH), iterator)]:
+        counts = token_count_many([sentence for _, sentence in batch])
+        for (offset, sentence), sentence_token_count in zip(batch, counts):
+            # If adding the next sentence exceeds the max_tokens limit,
+            # yield the current chunk and start a new one
+            if current and current_token_count + sentence_token_count > max_tokens:
+                if chunk := emit(current):
+                    yield chunk
+                current, current_token_count = tail(current) if overlap else ([], 0)
+                while current and current_token_count + sentence_token_count > max_tokens:
+                    current_token_count -= current.pop(0)[2]
+            current.append((offset, sentence, sentence_token_count))
+            current_token_count += sentence_token_count
+
+    # Yield the remaining chunk if it's not empty
+    if current and (chunk := emit(current)):
+        yield chunk
+
+def chunk_text(text, max_tokens, overlap=0):
+    return chunk_sentences(text_sentences(text), max_tokens, overlap=overlap)
+
+def split_text(text, max_tokens, overlap=0):
+    """
+    split a text into chunks of maximal token length, not breaking sentences in halves.
+    """
+    return [chunk for _, _, chunk in chunk_text(text, max_tokens, overlap=overlap)]
 
 def flattener(data):
     if data is None:
@@ -147,9 +486,96 @@ def keys_as_str(keys):
 def as_string(title,entry):
     return title+keys_as_str(entry[0])+"="+to_str(entry[1])
 
+def entry_size(entry):
+    return len(entry['string'])+ENTRY_OVERHEAD
+
 def subdict(original_dict, keys):
     return {k: original_dict[k] for k in keys if k in original_dict}
 
+class KeyNode:
+
+    __slots__=('entry','children')
+
+    def __init__(self):
+        self.entry=None
+        self.children={}
+
+class KeyTree:
+    """
+    Trie over the key sequences of a json document, mapping each leaf path to its content key.
+    Subtree lookup, containment and deletion cost O(depth + subtree size).
+    """
+
+    def __init__(self):
+        self.root=KeyNode()
+
+    def find(self,keys):
+        node=self.root
+        for key in keys:
+            node=node.children.get(key)
+            if node is None:
+                return None
+        return node
+
+    def path(self,keys):
+        nodes=[self.root]
+        for key in keys:
+            node=nodes[-1].children.get(key)
+            if node is None:
+                return None
+            nodes.append(node)
+        return nodes
+
+    def insert(self,keys,content_key):
+        node=self.root
+        for key in keys:
+            child=node.children.get(key)
+            if child is None:
+                child=node.children[key]=KeyNode()
+            node=child
+        node.entry=content_key
+
+    def prune(self,keys,nodes):
+        # Removes the empty nodes left at the end of a path
+        for i in range(len(keys),0,-1):
+            if nodes[i].entry is None and not nodes[i].children:
+                del nodes[i-1].children[keys[i-1]]
+            else:
+                break
+
+    def discard(self,keys):
+        nodes=self.path(keys)
+        if nodes is not None:
+            nodes[-1].entry=None
+            self.prune(keys,nodes)
+
+    def pop(self,keys):
+        """
+        detaches the subtree under keys and returns the content keys it held
+        """
+        nodes=self.path(keys)
+        if nodes is None:
+            return []
+        content_keys=list(self.iter_content_keys(nodes[-1]))
+        if keys:
+            del nodes[-2].children[keys[-1]]
+            self.prune(keys[:-1],nodes[:-1])
+        else:
+            self.root=KeyNode()
+        return content_keys
+
+    def iter_content_keys(self,node):
+        stack=[node]
+        while stack:
+            node=stack.pop()
+            if node.entry is not None:
+                yield node.entry
+            stack.extend(reversed(node.children.values()))
+
+    def content_keys(self,keys):
+        node=self.find(keys)
+        return [] if node is None else list(self.iter_content_keys(node))
+
 class Item:
 
     def __init__(self,document=None,keys=None):
@@ -158,11 +584,8 @@ class Item:
 
     @property
     def content(self):
-        content = {}
-        for entry in self.document.data['content'].values():
-            if is_prefix(self.keys,entry["keys"]):
-                content[keys_as_str(entry["keys"])]=entry
-        return content
+        content = self.document.data['content']
+        return {key:content[key] for key in self.document.tree.content_keys(self.keys)}
     
     @property
     def value(self):
@@ -176,7 +599,7 @@ class Item:
     def __getitem__(self,key):
         keys=self.keys+[key]
         
-        if is_in(keys,self.content):
+        if self.document.tree.find(keys) is not None:
             return Item(document=self.document, keys=keys)
         else:
             raise KeyError(f"Key {key} does not exist.")
@@ -189,14 +612,14 @@ class Item:
     def __delitem__(self, key):
         keys = self.keys + [key]
 
-        if is_in(keys,self.content):
+        if self.document.tree.find(keys) is not None:
             self.document.delete_value(keys)
         else:
             raise KeyError(f"Key {key} does not exist.")
         
     def __contains__(self,key):
         keys=self.keys+[key]
-        return is_in(keys,self.content)
+        return self.document.tree.find(keys) is not None
 
     def __repr__(self):
         return repr(self.value)
@@ -206,86 +629,525 @@ class Item:
     
     def search(self,query,num=10,threshold=0.25):
         vect=self.document.store.embed([query],self.document.data['precision'],self.document.data['dimensions'])[0]
-        results=[]
-        for entry in self.content.values():
-            results.append((entry["string"],np.dot(vect,entry["embedding"])))
-        results.sort(key=lambda result: result[1], reverse=True)
-        results=list(filter(lambda result:result[1]>=threshold,results))
-        return results[:num]
+        return self.search_vect(vect,num=num,threshold=threshold)
+
+    def search_vect(self,vect,num=10,threshold=0.25):
+        keys=None if not self.keys else self.document.tree.content_keys(self.keys)
+        return self.document.search_index(vect,num=num,threshold=threshold,keys=keys)
+
+class EntryReader:
+    """
+    Random access to the entries of a stored document, by row of its embedding matrix
+    """
+
+    def __init__(self,file,offsets_file):
+        self.file=file
+        self.offsets=np.load(offsets_file,mmap_mode='r')
+        self.handle=None
+        self.lock=Lock()
+
+    def read(self,row):
+        with self.lock:
+            if self.handle is None:
+                self.handle=open(self.file,'rb')
+            self.handle.seek(int(self.offsets[row]))
+            return json.loads(self.handle.readline())
+
+    def __iter__(self):
+        with open(self.file,'rb') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle=None
+
+class RowWriter:
+    """
+    Appends rows (key, entry, embedding) to the files of a snapshot generation being built:
+    the entries file itself, and raw float32 rows, int64 offsets and key lines turned into the final files by finish().
+    Opening it with rows>0 resumes after that many rows, dropping anything written past them.
+    """
+
+    def __init__(self,document,generation,rows=0):
+        self.document=document
+        self.generation=generation
+        self.dimensions=document.data['dimensions']
+        self.rows=rows
+        self.entries_path=document.snapshot_file('.entries',generation)
+        self.matrix_path=document.snapshot_file('.f32',generation)
+        self.offsets_path=document.snapshot_file('.offsets.i64',generation)
+        self.keys_path=document.snapshot_file('.keys',generation)
+        if rows==0:
+            for path in (self.entries_path,self.matrix_path,self.offsets_path,self.keys_path):
+                open(path,'wb').close()
+            np.zeros(1,dtype=np.int64).tofile(self.offsets_path)
+            self.size=0
+        else:
+            self.size=int(np.fromfile(self.offsets_path,dtype=np.int64,count=rows+1)[rows])
+            keys_size=0
+            with open(self.keys_path,'rb') as f:
+                for _ in range(rows):
+                    keys_size+=len(f.readline())
+            os.truncate(self.entries_path,self.size)
+            os.truncate(self.matrix_path,rows*self.dimensions*4)
+            os.truncate(self.offsets_path,(rows+1)*8)
+            os.truncate(self.keys_path,keys_size)
+        self.files=[open(path,'ab') for path in (self.entries_path,self.matrix_path,self.offsets_path,self.keys_path)]
+
+    def append(self,keys,entries,embeddings):
+        entries_file,matrix_file,offsets_file,keys_file=self.files
+        offsets=np.zeros(len(keys),dtype=np.int64)
+        for i,(key,entry) in enumerate(zip(keys,entries)):
+            line=(json.dumps([key,entry])+'\n').encode('utf-8')
+            entries_file.write(line)
+            keys_file.write((json.dumps(key)+'\n').encode('utf-8'))
+            self.size+=len(line)
+            offsets[i]=self.size
+        matrix_file.write(np.asarray(embeddings,dtype=np.float32).reshape(len(keys),self.dimensions).tobytes())
+        offsets_file.write(offsets.tobytes())
+        self.rows+=len(keys)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish(self):
+        """
+        writes the final matrix and offsets files, removes the raw ones, and returns the keys of the rows
+        """
+        self.flush()
+        for f in self.files:
+            f.close()
+        matrix_file=self.document.snapshot_file('.npy',self.generation)
+        if self.rows:
+            raw=np.memmap(self.matrix_path,dtype=np.float32,mode='r',shape=(self.rows,self.dimensions))
+            matrix=np.lib.format.open_memmap(matrix_file,mode='w+',dtype=np.float32,shape=(self.rows,self.dimensions))
+            for start in range(0,self.rows,65536):
+                matrix[start:start+65536]=raw[start:start+65536]
+            matrix.flush()
+            del raw,matrix
+        else:
+            np.save(matrix_file,np.zeros((0,self.dimensions),dtype=np.float32))
+        np.save(self.document.snapshot_file('.offsets.npy',self.generation),np.fromfile(self.offsets_path,dtype=np.int64))
+        with open(self.keys_path,'rb') as f:
+            keys=[json.loads(line) for line in f]
+        for path in (self.matrix_path,self.offsets_path,self.keys_path):
+            os.remove(path)
+        return keys
+
+class LazyContent(MutableMapping):
+    """
+    View of the content of a stored document: stored entries are only read from disk when accessed,
+    while entries changed since the snapshot (e.g. replayed from the journal) are held in memory as an overlay.
+    """
+
+    def __init__(self,reader,keys):
+        self.reader=reader
+        self.rows={key:row for row,key in enumerate(keys)}
+        self.overlay={}
+        self.overlay_size=0
+
+    def __getitem__(self,key):
+        if key in self.overlay:
+            return self.overlay[key]
+        stored_key,entry=self.reader.read(self.rows[key])
+        if stored_key!=key:
+            raise ValueError(f"Corrupted entries file: row {self.rows[key]} holds '{stored_key}' instead of '{key}'")
+        return entry
+
+    def __setitem__(self,key,entry):
+        self.rows.pop(key,None)
+        if key in self.overlay:
+            self.overlay_size-=entry_size(self.overlay[key])
+        self.overlay[key]=entry
+        self.overlay_size+=entry_size(entry)
+
+    def __delitem__(self,key):
+        if key in self.overlay:
+            self.overlay_size-=entry_size(self.overlay.pop(key))
+        else:
+            del self.rows[key]
+
+    def __contains__(self,key):
+        return key in self.overlay or key in self.rows
+
+    def __iter__(self):
+        yield from self.rows
+        yield from self.overlay
+
+    def __len__(self):
+        return len(self.rows)+len(self.overlay)
+
+    def materialize(self):
+        """
+        reads the stored entries sequentially, returning the whole content as a dict
+        """
+        content={key:entry for key,entry in self.reader if key in self.rows}
+        content.update(self.overlay)
+        return content
 
 class Document:
 
-    def __init__(self,store,file=None):
+    # Whether changes are appended to a write-ahead journal (see log) rather than requiring a full rewrite of the files
+    journaled=False
+
+    def __init__(self,store,file=None,compact_every=1000):
         self.store=store
         self.file=file
         self.data=dict()
+        self.index=None
+        self.journal=None
+        self.journal_ops=0
+        self.compact_every=compact_every
+        self.reader=None
+        self.content_size=0
+        self.generation=0
+
+    def snapshot_file(self,ext,generation=None):
+        generation=self.generation if generation is None else generation
+        base=os.path.splitext(self.file)[0]
+        return base+ext if generation==0 else f"{base}.{generation}{ext}"
+
+    @property
+    def sidecar(self):
+        return self.snapshot_file('.npy')
+
+    @property
+    def index_file(self):
+        return self.snapshot_file('.index.npz')
+
+    @property
+    def journal_file(self):
+        return os.path.splitext(self.file)[0]+'.journal'
+
+    @property
+    def entries_file(self):
+        return self.snapshot_file('.entries')
+
+    @property
+    def offsets_file(self):
+        return self.snapshot_file('.offsets.npy')
+
+    @property
+    def is_lazy(self):
+        return isinstance(self.data.get('content'),LazyContent)
 
-    def load(self,file=None):
+    def load(self,file=None,lazy=False):
         self.file=file or self.file
-        if os.path.isfile(self.file) and file.endswith('.json'):
-            with open(file) as f:
-                self.data=json.load(f)
+        if os.path.isfile(self.file) and self.file.endswith('.json'):
+            with open(self.file) as f:
+                self.set_data(json.load(f),lazy=lazy)
+
+    def materialize(self):
+        """
+        reads all the entries of a lazily loaded document in memory
+        """
+        if self.is_lazy:
+            self.data['content']=self.data['content'].materialize()
+            self.content_size=sum(entry_size(entry) for entry in self.data['content'].values())
+
+    def unload(self):
+        """
+        drops the entries from memory, reopening the document lazily.
+        Journaled changes are replayed over the snapshot as an in-memory overlay, the snapshot being only rewritten by dump
+        """
+        if self.file and not self.is_lazy:
+            self.load(lazy=True)
+
+    def memory_usage(self):
+        """
+        rough estimate of the memory held by the document (memory-mapped data excluded)
+        """
+        usage=0 if isinstance(self.index.matrix,np.memmap) else self.index.matrix.nbytes
+        if self.is_lazy:
+            content=self.data['content']
+            return usage+ENTRY_OVERHEAD//4*len(content.rows)+content.overlay_size
+        return usage+self.content_size
 
     def dump(self,file=None):
+        """
+        saves the document. Journaled changes are already on disk, so the snapshot is only rewritten
+        once compact_every operations have accumulated in the journal.
+        """
+        if (file is None or file==self.file) and self.journal is not None and self.journal_ops<self.compact_every:
+            self.journal.flush()
+        else:
+            self.compact(file)
+
+    def compact(self,file=None):
+        """
+        writes a full snapshot of the document and starts a new empty journal.
+        The files of the new generation are written aside, the json file being replaced last:
+        an interrupted compaction leaves the previous snapshot intact.
+        """
+        previous=[self.sidecar,self.entries_file,self.offsets_file,self.index_file] if self.file==(file or self.file) else []
         self.file=file or self.file
         if self.file.endswith('.json'):
-            with open(self.file,'w') as f:
-                json.dump(self.data,f)
-
-    def set_data(self,data):
+            self.materialize()
+            content=self.data['content']
+            generation=self.generation+1
+            with open(self.snapshot_file('.npy',generation),'wb') as f:
+                np.save(f,self.index.values)
+            offsets=np.zeros(len(self.index.keys)+1,dtype=np.int64)
+            with open(self.snapshot_file('.entries',generation),'wb') as f:
+                for row,key in enumerate(self.index.keys):
+                    line=(json.dumps([key,content[key]])+'\n').encode('utf-8')
+                    f.write(line)
+                    offsets[row+1]=offsets[row]+len(line)
+            with open(self.snapshot_file('.offsets.npy',generation),'wb') as f:
+                np.save(f,offsets)
+            self.index.dump_state(self.snapshot_file('.index.npz',generation))
+            self.commit(generation,self.index.keys,previous)
+
+    def write_metadata(self,generation,rows):
+        metadata={key:value for key,value in self.data.items() if key!='content'}
+        with open(self.file+'.tmp','w') as f:
+            json.dump(dict(format=FORMAT_VERSION,**metadata,generation=generation,rows=rows),f)
+        os.replace(self.file+'.tmp',self.file)
+
+    def commit(self,generation,rows,previous=()):
+        """
+        makes the snapshot files of generation the current ones, by replacing the json file, and removes the previous files
+        """
+        self.write_metadata(generation,rows)
+        self.generation=generation
+        if self.reader is not None:
+            self.reader.close()
+            self.reader=None
+        for path in previous:
+            try:
+                os.remove(path)
+            except OSError:
+                # Missing, or still mapped on a platform that forbids removing it
+                pass
+        self.reset_journal()
+
+    def reset_journal(self):
+        self.close_journal()
+        if self.journaled:
+            self.journal=open(self.journal_file,'w')
+
+    def open_journal(self):
+        self.close_journal()
+        if self.journaled:
+            self.journal=open(self.journal_file,'a')
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal=None
+        self.journal_ops=0
+
+    def close(self):
+        self.close_journal()
+        if self.reader is not None:
+            self.reader.close()
+            self.reader=None
+
+    def log(self,op):
+        if self.journal is not None:
+            self.journal.write(json.dumps(op)+'\n')
+            self.journal.flush()
+            self.journal_ops+=1
+
+    def replay_journal(self):
+        """
+        applies the operations journaled since the last snapshot.
+        Operations are absolute (add or remove an entry), so replaying them over a snapshot that already contains them is harmless.
+        """
+        count=0
+        size=0
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file,'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError
+                        op=json.loads(line)
+                    except ValueError:
+                        # Torn last write: cut it off so that new operations are appended after the last complete one
+                        os.truncate(self.journal_file,size)
+                        break
+                    if op['op']=='add':
+                        self.add_entry(op['key'],op['entry'],op['embedding'])
+                    elif op['op']=='remove' and op['key'] in self.data['content']:
+                        self.remove_entry(op['key'])
+                    size+=len(line)
+                    count+=1
+        return count
+
+    def set_data(self,data,lazy=False):
+        """
+        sets the document's data as loaded from its json file.
+        In lazy mode, only the metadata and the memory-mapped embedding matrix are loaded, entries being read on access.
+        """
+        self.close()
+        data=dict(data)
+        version=data.pop('format',1)
+        rows=data.pop('rows',None)
+        self.generation=data.pop('generation',0)
         self.data=data
+        if version>=2:
+            self.reset_index()
+            matrix=np.load(self.sidecar,mmap_mode='r')
+            if len(matrix)!=len(rows):
+                raise ValueError(f"Inconsistent snapshot of {self.file}: {len(matrix)} embeddings for {len(rows)} rows")
+            self.index.load_matrix(matrix,rows)
+            self.index.load_state(self.index_file)
+            if version>=3:
+                self.reader=EntryReader(self.entries_file,self.offsets_file)
+                if len(self.reader.offsets)!=len(rows)+1:
+                    raise ValueError(f"Inconsistent snapshot of {self.file}: {len(self.reader.offsets)-1} entries for {len(rows)} rows")
+                self.data['content']=LazyContent(self.reader,rows)
+                if not lazy:
+                    self.materialize()
+            else:
+                self.content_size=sum(entry_size(entry) for entry in self.data['content'].values())
+        else:
+            # Legacy layout: embeddings are inlined in the json entries
+            self.reset_index()
+            for key,entry in self.data['content'].items():
+                self.index.add(key,entry.pop('embedding'))
+            self.content_size=sum(entry_size(entry) for entry in self.data['content'].values())
+
+    def reset_index(self):
+        self.index=make_index(self.data['dimensions'],self.data.get('index'))
+
+    def set_index(self,type='flat',**params):
+        """
+        switches the document to another index type (see INDEX_TYPES), reusing the stored embeddings
+        """
+        values,keys=np.array(self.index.values),self.index.keys
+        self.data['index']=dict(type=type,**params)
+        self.reset_index()
+        self.index.load_matrix(values,keys)
+
+    def recall(self,k=10,sample=100):
+        """
+        recall@k of the document's index against the exact scan, using a sample of the stored embeddings as queries
+        """
+        values=self.index.values
+        rng=np.random.default_rng(0)
+        rows=rng.choice(len(values),min(sample,len(values)),replace=False)
+        return self.index.recall(values[rows],k=k)
+
+    def add_entry(self,key,entry,embedding):
+        # A lazily loaded document keeps the change in its overlay (see LazyContent)
+        content=self.data['content']
+        if not self.is_lazy:
+            if key in content:
+                self.content_size-=entry_size(content[key])
+            self.content_size+=entry_size(entry)
+        content[key]=entry
+        self.index.add(key,embedding)
+        self.log(dict(op='add',key=key,entry=entry,embedding=np.asarray(embedding,dtype=float).tolist()))
+
+    def remove_entry(self,key):
+        if self.is_lazy:
+            del self.data['content'][key]
+        else:
+            self.content_size-=entry_size(self.data['content'].pop(key))
+        self.index.remove(key)
+        self.log(dict(op='remove',key=key))
 
+    def search_index(self,vect,num=10,threshold=0.25,keys=None):
+        content=self.data['content']
+        return [(content[key]['string'],score) for key,score in self.index.search(vect,num=num,threshold=threshold,keys=keys)]
+
+    def search(self,query,num=10,threshold=0.25):
+        vect=self.store.embed([query],self.data['precision'],self.data['dimensions'])[0]
+        return self.search_vect(vect,num=num,threshold=threshold)
+
+    def search_vect(self,vect,num=10,threshold=0.25):
+        return self.search_index(vect,num=num,threshold=threshold)
 
 
 class JsonDocument(Item,Document):
 
+    journaled=True
+
     def __init__(self,store,file=None):
         Item.__init__(self,document=self,keys=[])
-        Document.__init__(self,store,file)           
+        Document.__init__(self,store,file)
+        self._tree=KeyTree()
 
-    def load_data(self,title,content,description,precision,dimensions):
+    @property
+    def tree(self):
+        # Built on first access, so that a lazily loaded document is only read in full when browsed or changed
+        if self._tree is None:
+            self.materialize()
+            self._tree=KeyTree()
+            for key,entry in self.data['content'].items():
+                self._tree.insert(entry['keys'],key)
+        return self._tree
+
+    def set_data(self,data,lazy=False):
+        Document.set_data(self,data,lazy=lazy)
+        self._tree=None
+        ops=self.replay_journal()
+        self.open_journal()
+        self.journal_ops=ops
+
+    def add_entry(self,key,entry,embedding):
+        Document.add_entry(self,key,entry,embedding)
+        # Otherwise the tree is built from the content on first access
+        if self._tree is not None:
+            self._tree.insert(entry['keys'],key)
+
+    def remove_entry(self,key):
+        if self._tree is not None:
+            self._tree.discard(self.data['content'][key]['keys'])
+        Document.remove_entry(self,key)
+
+    def load_data(self,title,content,description,precision,dimensions,index=None,progress=None):
         self.data=dict(
             title=title,
             type='json',
             description=description,
             precision=precision,
             dimensions=dimensions,
+            index=index or dict(type='flat'),
             content=dict()
         )
+        self.reset_index()
+        self._tree=KeyTree()
         if isinstance(content,str) and content.endswith(".json") and os.path.isfile(content):
-            self.load_json_file(json_file=content)
+            self.load_json_file(json_file=content,progress=progress)
         elif isinstance(content,str):
-            self.load_json_string(json_string=content)
+            self.load_json_string(json_string=content,progress=progress)
         else:
-            self.load_json_data(content)
+            self.load_json_data(content,progress=progress)
 
-    def load_json_data(self,json_data):
+    def load_json_data(self,json_data,progress=None):
         entries=flattener(json_data)
         strings=[as_string(self.data['title'],entry) for entry in entries]
-        embeddings=self.store.embed(strings,self.data['precision'],self.data['dimensions'])
+        embeddings=self.store.embed(strings,self.data['precision'],self.data['dimensions'],progress=progress)
         for i in range(len(entries)):
             keys,value=entries[i]
-            self.data['content'][keys_as_str(keys)]=dict(
+            self.add_entry(keys_as_str(keys),dict(
                 keys=keys,
                 value=value,
-                string=strings[i],
-                embedding=embeddings[i]
-            )
+                string=strings[i]
+            ),embeddings[i])
 
-    def load_json_string(self,json_string):
+    def load_json_string(self,json_string,progress=None):
         json_data=json.loads(json_string)
-        self.load_json_data(json_data)
+        self.load_json_data(json_data,progress=progress)
 
-    def load_json_file(self,json_file):
+    def load_json_file(self,json_file,progress=None):
         if os.path.isfile(json_file) and json_file.endswith('.json'):
             with open(json_file,'w') as f:
                 json_data=json.load(f)
-            self.load_json_data(json_data)
+            self.load_json_data(json_data,progress=progress)
 
     def set_value(self, keys, value):
 
         if "" in self.data['content']:
-            del self.data['content'][""]
+            self.remove_entry("")
 
         # Check and remove existing content (if any) under the specified keys
         self.delete_value(keys)
@@ -298,94 +1160,188 @@ class JsonDocument(Item,Document):
             embeddings=self.store.embed(strings,self.data['precision'],self.data['dimensions'])
             for i in range(len(entries)):
                 keys,value=entries[i]
-                self.data['content'][keys_as_str(keys)]=dict(
+                self.add_entry(keys_as_str(keys),dict(
                     keys=keys,
                     value=value,
-                    string=strings[i],
-                    embedding=embeddings[i]
-                )
+                    string=strings[i]
+                ),embeddings[i])
         else:
             string = as_string(self.data['title'],(keys, value))
             embedding = self.store.embed([string],self.data['precision'],self.data['dimensions'])[0]
-            self.data['content'][keys_as_str(keys)]=dict(
+            self.add_entry(keys_as_str(keys),dict(
                 keys= keys,
                 value= value,
-                string=string,
-                embedding=embedding
-            )
+                string=string
+            ),embedding)
 
     def delete_value(self, keys):
         # Remove the entry or nested entries starting with the specified keys
-        to_remove = [key for key in self.data['content'] if is_prefix(keys, key)]
-        for key in to_remove:
-            del self.data['content'][key]
+        for key in self.tree.pop(keys):
+            Document.remove_entry(self,key)
 
 class TextDocument(Document):
 
-    def __init__(self,store,file=None,chunk_size=100):
+    def __init__(self,store,file=None,chunk_size=100,overlap=0):
         Document.__init__(self,store=store,file=file)
         self.chunk_size=chunk_size
+        self.overlap=overlap
 
-    def load_data(self,title,content,description,precision,dimensions):
+    def load_data(self,title,content,description,precision,dimensions,index=None,progress=None):
         self.data=dict(
             title=title,
             type='text',
             description=description,
             precision=precision,
             dimensions=dimensions,
+            index=index or dict(type='flat'),
             content=dict()
         )
-        strings=split_text(content,self.chunk_size)
-        embeddings=self.store.embed(strings,precision,dimensions)
-        n=0
-        for i in range(len(strings)):
-            keys=[n+1,n+len(strings[i])]
-            self.data['content'][str(keys)]=dict(keys=keys,string=strings[i],embedding=embeddings[i])
-            n+=len(strings[i])
-
-    def search(self,query,num=10,threshold=0.25):
-        vect=self.store.embed([query],self.data['precision'],self.data['dimensions'])[0]
-        results=[]
-        for entry in self.data["content"].values():
-            results.append((entry['string'],np.dot(vect,entry["embedding"])))
-        results.sort(key=lambda result: result[1], reverse=True)
-        results=list(filter(lambda result:result[1]>=threshold,results))
-        return results[:num]
+        self.reset_index()
+        chunks=list(chunk_text(content,self.chunk_size,overlap=self.overlap))
+        embeddings=self.store.embed([chunk for _,_,chunk in chunks],precision,dimensions,progress=progress)
+        self.append_chunks(chunks,embeddings)
+
+    def append_chunks(self,chunks,embeddings):
+        # keys are the 1-based inclusive character span of the chunk in the source text
+        for (start,end,string),embedding in zip(chunks,embeddings):
+            keys=[start+1,end]
+            self.add_entry(str(keys),dict(keys=keys,string=string),embedding)
+
+    def ingest(self,blocks,batch_size=512,checkpoint_every=10,progress=None):
+        """
+        streams text blocks into the document with bounded memory: chunks are embedded and appended batch by batch
+        to the files of a new snapshot generation (see RowWriter), the document in memory staying as it was.
+        Every checkpoint_every batches, the files are synced and only the json metadata is rewritten to record the progress.
+        If the document holds a checkpoint from an interrupted ingestion of the same source, the chunks already ingested are skipped.
+        progress is an optional callback(done,total) called after each batch (total is None, the stream length being unknown).
+        The document is reopened lazily once done.
+        """
+        checkpoint=self.data.get('ingest')
+        if checkpoint is not None and 'generation' in checkpoint:
+            writer=RowWriter(self,checkpoint['generation'],rows=checkpoint['rows'])
+        else:
+            checkpoint=self.data['ingest']=dict(chunks=(checkpoint or {}).get('chunks',0))
+            if not self.is_lazy:
+                # Make sure the document has a committed snapshot to fall back on
+                self.compact()
+            # The new generation starts with the rows the document already holds
+            writer=RowWriter(self,self.generation+1)
+            keys=self.index.keys
+            for start in range(0,len(keys),batch_size):
+                batch_keys=keys[start:start+batch_size]
+                writer.append(batch_keys,[self.data['content'][key] for key in batch_keys],self.index.values[start:start+batch_size])
+            checkpoint.update(generation=writer.generation,rows=writer.rows)
+        skip=checkpoint['chunks']
+        batch=[]
+        batches=0
+
+        def flush(batch):
+            embeddings=self.store.embed([chunk for _,_,chunk in batch],self.data['precision'],self.data['dimensions'])
+            keys=[[start+1,end] for start,end,_ in batch]
+            writer.append([str(key) for key in keys],[dict(keys=key,string=string) for key,(_,_,string) in zip(keys,batch)],embeddings)
+            checkpoint['chunks']+=len(batch)
+            checkpoint['rows']=writer.rows
+            if progress:
+                progress(checkpoint['chunks'],None)
+
+        for i,chunk in enumerate(chunk_sentences(stream_sentences(blocks),self.chunk_size,overlap=self.overlap)):
+            if i<skip:
+                continue
+            batch.append(chunk)
+            if len(batch)>=batch_size:
+                flush(batch)
+                batch=[]
+                batches+=1
+                if batches%checkpoint_every==0:
+                    writer.flush()
+                    self.write_metadata(self.generation,self.index.keys)
+        if batch:
+            flush(batch)
+        del self.data['ingest']
+        previous=[self.sidecar,self.entries_file,self.offsets_file,self.index_file]
+        keys=writer.finish()
+        self.commit(writer.generation,keys,previous)
+        self.load(lazy=True)
 
 class DocumentStore:
 
-    def __init__(self,openai_api_key=None,folder='./documents',dimensions=128,precision=5):
+    def __init__(self,openai_api_key=None,folder='./documents',dimensions=128,precision=5,index=None,cache_file=None,cache_size=100000,max_workers=4,max_retries=6,chunk_size=100,chunk_overlap=0,lazy=False,memory_budget=None):
         self.openai_api_key=openai_api_key
+        self.lazy=lazy
+        self.memory_budget=memory_budget
+        self.chunk_size=chunk_size
+        self.chunk_overlap=chunk_overlap
+        self.max_workers=max_workers
+        self.max_retries=max_retries
+        self.index=index or dict(type='flat')
         self.client=OpenAI(api_key=openai_api_key or os.getenv("OPENAI_API_KEY"))
+        self.model="text-embedding-3-small"
         self.dimensions=dimensions
         self.precision=precision
         self.folder=folder
         self.store={}
+        # Guards the loaded documents: searches may run from several threads at once (see IPyAgent.acall)
+        self.lock=RLock()
         if not os.path.exists(self.folder):
             os.makedirs(self.folder)
+        self.cache=EmbeddingCache(cache_file or os.path.join(self.folder,"embeddings_cache.db"),max_entries=cache_size)
 
-    def embed(self,strings,precision,dimensions):
-        success=False
-        while not success:
+    def request_embeddings(self,strings,dimensions):
+        # Exponential backoff with jitter, giving up after max_retries retries
+        for attempt in range(self.max_retries+1):
             try:
                 response=self.client.embeddings.create(
                     input=strings,
-                    model="text-embedding-3-small",
+                    model=self.model,
                     dimensions=dimensions
                 )
             except Exception as e:
-                print(str(e))
-                success=False
+                if attempt==self.max_retries:
+                    raise
+                delay=min(60,2**attempt)*random.uniform(0.5,1.5)
+                print(f"{str(e)}\nRetrying in {delay:.1f}s...")
+                time.sleep(delay)
             else:
-                success=True
-        embeddings=[normalize(response.data[i].embedding,precision) for i in range(len(strings))]
+                return [response.data[i].embedding for i in range(len(strings))]
+
+    def fetch_embeddings(self,strings,dimensions,progress=None):
+        """
+        embeds strings through concurrent batched requests, returning the vectors in the original order.
+        Each completed batch is cached right away so that an interrupted run resumes where it stopped.
+        progress is an optional callback(done,total) called as batches complete.
+        """
+        batches=make_batches(strings)
+        results=[None]*len(batches)
+        done=0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures={pool.submit(self.request_embeddings,batch,dimensions):i for i,batch in enumerate(batches)}
+            for future in as_completed(futures):
+                i=futures[future]
+                results[i]=np.asarray(future.result(),dtype=np.float32)
+                self.cache.set_many(self.model,dimensions,batches[i],results[i])
+                done+=len(batches[i])
+                if progress:
+                    progress(done,len(strings))
+        return list(chain.from_iterable(results))
+
+    def embed(self,strings,precision,dimensions,progress=None):
+        # Only strings missing from the cache are sent to the API (once each, even if repeated)
+        vects=self.cache.get_many(self.model,dimensions,strings)
+        missing=list(dict.fromkeys(strings[i] for i,vect in enumerate(vects) if vect is None))
+        if missing:
+            fetched=dict(zip(missing,self.fetch_embeddings(missing,dimensions,progress=progress)))
+            vects=[fetched[strings[i]] if vect is None else vect for i,vect in enumerate(vects)]
+        embeddings=[normalize(vect,precision) for vect in vects]
         return embeddings
 
+    def cache_stats(self):
+        return self.cache.stats()
+
     def get_loaded(self):
         return [dict(title=doc.data['title'],description=doc.data['description']) for doc in self.store.values()]
     
     def get_titles(self):
-        return [os.path.basename(file).split('.')[0] for file in os.listdir(self.folder)]
+        return [os.path.splitext(file)[0] for file in os.listdir(self.folder) if file.endswith('.json')]
     
     def save_document(self,title):
         if title in self.store:
@@ -394,47 +1350,123 @@ class DocumentStore:
             print(f"Successfully saved document '{title}' : path='{file}'")
 
     def get_document(self,title):
-        if title in self.store:
-            return self.store[title]
-            
-    def load_document(self,title):
-        if title not in self.store:
-            file=os.path.join(self.folder,f"{title}.json")
-            if os.path.isfile(file):
-                with open(file) as f:
-                    data=json.load(f)
-                if data['type']=='json':
-                    doc=JsonDocument(store=self,file=file)
-                elif data['type']=='text':
-                    doc=TextDocument(store=self,file=file)
-                doc.set_data(data)
-                self.store[title]=doc
-                print(f"Successfully loaded document '{title}' : path='{file}'")
+        with self.lock:
+            if title in self.store:
+                self.touch(title)
+                doc=self.store[title]
+                self.enforce_budget()
+                return doc
+
+    def touch(self,title):
+        # self.store is kept in least to most recently used order
+        self.store[title]=self.store.pop(title)
+
+    def memory_usage(self):
+        return sum(doc.memory_usage() for doc in self.store.values())
+
+    def enforce_budget(self):
+        """
+        unloads the least recently used documents (keeping them open lazily for retrieval) until the estimated memory usage fits in memory_budget (bytes)
+        """
+        if self.memory_budget is None:
+            return
+        with self.lock:
+            usage=self.memory_usage()
+            for doc in list(self.store.values())[:-1]:
+                if usage<=self.memory_budget:
+                    break
+                before=doc.memory_usage()
+                doc.unload()
+                usage-=before-doc.memory_usage()
+
+    def load_document(self,title,lazy=None):
+        lazy=self.lazy if lazy is None else lazy
+        with self.lock:
+            if title not in self.store:
+                file=os.path.join(self.folder,f"{title}.json")
+                if os.path.isfile(file):
+                    with open(file) as f:
+                        data=json.load(f)
+                    if data['type']=='json':
+                        doc=JsonDocument(store=self,file=file)
+                    elif data['type']=='text':
+                        doc=TextDocument(store=self,file=file,chunk_size=self.chunk_size,overlap=self.chunk_overlap)
+                    doc.set_data(data,lazy=lazy)
+                    if data.get('format',1)<FORMAT_VERSION:
+                        # One-time migration of older layouts to the current one
+                        doc.compact()
+                        print(f"Migrated document '{title}' to storage format {FORMAT_VERSION}")
+                    self.store[title]=doc
+                    self.enforce_budget()
+                    print(f"Successfully loaded document '{title}' : path='{file}'")
 
     def close_document(self,title):
-        if title in self.store:
-            del self.store[title]
-            print(f"Successfully closed document '{title}'")
+        with self.lock:
+            if title in self.store:
+                self.store[title].close()
+                del self.store[title]
+                print(f"Successfully closed document '{title}'")
 
-    def new_document(self,type,title,content,description,precision=5,dimensions=128):
+    def new_document(self,type,title,content,description,precision=5,dimensions=128,index=None,progress=None):
         file=os.path.join(self.folder,f"{title}.json")
         if type=='json':
             doc=JsonDocument(store=self,file=file)
         elif type=='text':
-            doc=TextDocument(store=self,file=file)
-        doc.load_data(title=title,content=content,description=description,precision=precision,dimensions=dimensions)
-        self.store[title]=doc
+            doc=TextDocument(store=self,file=file,chunk_size=self.chunk_size,overlap=self.chunk_overlap)
+        doc.load_data(title=title,content=content,description=description,precision=precision,dimensions=dimensions,index=index or self.index,progress=progress)
         doc.dump()
+        with self.lock:
+            self.store[title]=doc
+            self.enforce_budget()
+        print(f"Successfully created document '{title}' : path='{file}'")
+
+    def ingest(self,title,source,description,precision=5,dimensions=128,index=None,progress=None,batch_size=512,checkpoint_every=10):
+        """
+        creates a text document from a possibly huge source (path of a text file, or any iterable of text blocks)
+        with bounded memory, resuming a previously interrupted ingestion under the same title if any.
+        """
+        file=os.path.join(self.folder,f"{title}.json")
+        doc=TextDocument(store=self,file=file,chunk_size=self.chunk_size,overlap=self.chunk_overlap)
+        data=None
+        if os.path.isfile(file):
+            with open(file) as f:
+                data=json.load(f)
+        if data and data['type']=='text' and 'ingest' in data:
+            doc.set_data(data,lazy=True)
+            print(f"Resuming ingestion of document '{title}' after {data['ingest']['chunks']} chunks")
+        else:
+            doc.load_data(title=title,content='',description=description,precision=precision,dimensions=dimensions,index=index or self.index)
+        blocks=read_blocks(source) if isinstance(source,str) else source
+        doc.ingest(blocks,batch_size=batch_size,checkpoint_every=checkpoint_every,progress=progress)
+        with self.lock:
+            self.store[title]=doc
+            self.enforce_budget()
         print(f"Successfully created document '{title}' : path='{file}'")
 
     def search(self,query,titles='all',num=10,threshold=0.35):
-        if titles=='all':
-            titles=self.store.keys()
+        with self.lock:
+            titles=list(self.store) if titles=='all' else list(titles)
+            settings={(self.store[title].data['precision'],self.store[title].data['dimensions']) for title in titles}
+        # The query is embedded once per (precision, dimensions) setting rather than once per document,
+        # without holding the lock during the request
+        vects={setting:self.embed([query],*setting)[0] for setting in settings}
         results={}
-        for title in titles:
-            results[title]=self.store[title].search(query,num=num,threshold=threshold)
+        with self.lock:
+            for title in titles:
+                # Skip a document closed meanwhile
+                doc=self.store.get(title)
+                if doc is not None:
+                    setting=(doc.data['precision'],doc.data['dimensions'])
+                    results[title]=doc.search_vect(vects[setting],num=num,threshold=threshold)
+                    self.touch(title)
+            self.enforce_budget()
         return results
 
+    def recall(self,titles='all',k=10,sample=100):
+        if titles=='all':
+            titles=self.store.keys()
+        return {title:self.store[title].recall(k=k,sample=sample) for title in titles}
+
 
 if __name__=='__main__':
 
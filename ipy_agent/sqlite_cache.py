@@ -0,0 +1,92 @@
+import sqlite3
+import hashlib
+import os
+from threading import Lock
+
+def content_hash(source):
+    """
+    sha256 of a file (path) or of bytes
+    """
+    digest=hashlib.sha256()
+    if isinstance(source,bytes):
+        digest.update(source)
+    else:
+        with open(source,'rb') as f:
+            for block in iter(lambda: f.read(1<<20),b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+class SQLiteCache:
+    """
+    Base of the persistent caches stored in a SQLite table, evicted in LRU order.
+    Subclasses define the table (its columns must include last_used), the weight of a row (an SQL expression)
+    and the capacity, the total weight above which the least recently used rows are evicted.
+    """
+
+    table=None
+    columns=None
+    weight="1"
+
+    def __init__(self,file,capacity):
+        self.file=file
+        self.capacity=capacity
+        self.hits=0
+        self.misses=0
+        self.lock=Lock()
+        self._conn=None
+        self.pid=None
+        with self.lock:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({self.columns})")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS lru ON {self.table} (last_used)")
+            self.conn.commit()
+
+    @property
+    def conn(self):
+        # A connection must not be shared with a forked process (e.g. the workers of get_text_many)
+        if self.pid!=os.getpid():
+            self._conn=sqlite3.connect(self.file,timeout=30,check_same_thread=False)
+            self.pid=os.getpid()
+        return self._conn
+
+    def count(self,hits,misses):
+        # Called with the lock held
+        self.hits+=hits
+        self.misses+=misses
+
+    def total_weight(self):
+        return self.conn.execute(f"SELECT COALESCE(SUM({self.weight}),0) FROM {self.table}").fetchone()[0]
+
+    def evict(self):
+        """
+        deletes the least recently used rows until the total weight fits in capacity (called with the lock held)
+        """
+        excess=self.total_weight()-self.capacity
+        if excess>0:
+            self.conn.execute(f"""
+                DELETE FROM {self.table} WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid,SUM({self.weight}) OVER (ORDER BY last_used,rowid)-{self.weight} AS before FROM {self.table}
+                    ) WHERE before<?
+                )
+            """,(excess,))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute(f"DELETE FROM {self.table}")
+            self.conn.commit()
+            self.hits=0
+            self.misses=0
+
+    def stats(self):
+        with self.lock:
+            total=self.hits+self.misses
+            return dict(
+                entries=self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0],
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits/total if total else 0.0
+            )
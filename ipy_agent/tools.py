@@ -1,6 +1,6 @@
 from textwrap import dedent
-from .get_text import get_text
-from .get_webdriver import get_webdriver
+from .get_text import get_text, get_text_many
+from .get_webdriver import lease_webdriver
 from .google_search import init_google_search
 from IPython import get_ipython
 import webbrowser
@@ -139,11 +139,12 @@ def init_tools(agent):
 
     agent.add_tool(
         name='webdriver',
-        obj=get_webdriver,
+        obj=lease_webdriver,
         description=dedent("""
         driver=agent.webdriver()
-        Spawns a preconfigured and ready to be used selenium headless firefox webdriver, suitable to work in the current environment. 
+        Leases a preconfigured and ready to be used selenium headless firefox webdriver from a pool of warm sessions, suitable to work in the current environment. 
         You should always use this driver rather than attempting to configure one yourself.
+        Always call driver.quit() when done: it returns the driver to the pool.
         
         Example:
         # Spawn the webdriver
@@ -171,6 +172,7 @@ def init_tools(agent):
         url : get the text content extracted from the web page
         basic data type : a text representation of the content,
         object / function / class / module : a complete instrospection of the object
+        list : each source of the list, extracted in parallel and observed together
         ...
         """)
     )
@@ -179,11 +181,12 @@ def init_tools(agent):
         name="get_text",
         obj=get_text,
         description=dedent("""
-        text_content=agent.get_text(source) 
+        text_content=agent.get_text(source,pages=None,max_tokens=None) 
         Extracts and returns textual data from any kind of source (folder,file,url,variable,function,class,module...). 
         Similar to agent.observe, but the text content is returned instead of being injected in context.
         folder : get the recursive tree content.
         file : get the file content as text (supported: pdf,doc,odt,xlsx,csv,ods,...),
+        For a pdf, pages=(first,last) restricts extraction to a page range, and max_tokens extracts only the first and last pages fitting the budget.
         url : get the text content extracted from the web page
         basic data type : a text representation of the content,
         object / function / class / module : a complete instrospection of the object
@@ -191,6 +194,17 @@ def init_tools(agent):
         """)
     )
 
+    agent.add_tool(
+        name="get_text_many",
+        obj=get_text_many,
+        description=dedent("""
+        texts=agent.get_text_many(sources,workers=8,timeout=60,pages=None,max_tokens=None)
+        Same as agent.get_text for a list of sources, extracted in parallel (urls in threads, pdf/docx/odt files in processes).
+        timeout (seconds) applies to each source, from the moment it starts. pages and max_tokens apply to each source.
+        Returns the texts in the same order, with an error message in place of a source that failed or timed out.
+        """)
+    )
+
     agent.add_tool(
         name="document_store",
         obj=agent.store,
@@ -202,6 +216,7 @@ def init_tools(agent):
             agent.document_store.get_titles() # returns the list of titles of documents saved as files in the document store (can be loaded in memory).
             agent.document_store.get_loaded() # returns the list of titles of documents currently loaded in memory and active for chunk retrieval.
             agent.document_store.new_document(type,title,content,description) # (type='text' or 'json') Create a new stored document from a given content (either text or json_data, json_string, json_file) that is parsed, embedded and loaded for semantic search.
+            agent.document_store.ingest(title,source,description) # Streams a large text file (path) or iterable of text blocks into a new text document with bounded memory. Resumes if previously interrupted.
             agent.document_store.load_document(title) # Loads a document in memory.
             agent.document_store.close_document(title) # unloads a document from memory.
             agent.document_store.search(query,num=10) # returns most relevant pieces of informations found in the loaded documents related to a query.
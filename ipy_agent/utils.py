@@ -1,9 +1,12 @@
 import os
 from IPython import get_ipython
 import tiktoken
-from .attrdict import AttrDict
 from datetime import datetime
+from itertools import count
+import time
 import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 os.environ['ROOT_PATH']=os.path.dirname(os.path.abspath(__file__))
 
@@ -39,25 +42,116 @@ def shell_type(shell):
 tokenizer = tiktoken.get_encoding("cl100k_base")
 
 def tokenize(string):
+    # Decodes all token bytes in a single call rather than one decode call per token
     int_tokens = tokenizer.encode(string)
-    str_tokens = [tokenizer.decode([int_token]) for int_token in int_tokens]
+    str_tokens = [token.decode('utf-8', errors='replace') for token in tokenizer.decode_tokens_bytes(int_tokens)]
     return str_tokens
 
 def token_count(string):
     return len(tokenizer.encode(string))
 
-def Message(content, role, name, type, lasting=0):
-    return AttrDict(content=content, role=role, name=name, type=type, lasting=lasting, timestamp=datetime.now().isoformat())
+def token_count_many(strings, num_threads=8):
+    return [len(tokens) for tokens in tokenizer.encode_batch(strings, num_threads=num_threads)]
+
+# Global creation order of messages
+_message_seq = count()
+
+class Message:
+    """
+    Compact message record, ordered by a monotonic sequence number.
+    Its token count is computed on first use and cached until its content or name changes.
+    Mapping-style access (msg['content'], msg.get('name')...) is kept for code written against the former dict messages.
+    """
+
+    __slots__ = ('_content', 'role', '_name', 'type', 'lasting', 'seq', 'created', '_tokens')
+
+    fields = ('content', 'role', 'name', 'type', 'lasting', 'timestamp')
+
+    def __init__(self, content, role, name, type, lasting=0):
+        self._content = content
+        self.role = role
+        self._name = name
+        self.type = type
+        self.lasting = lasting
+        self.seq = next(_message_seq)
+        self.created = time.time()
+        self._tokens = None
+
+    @property
+    def content(self):
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._tokens = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+        self._tokens = None
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created).isoformat()
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = total_tokens([self])
+        return self._tokens
+
+    def to_api_dict(self):
+        return dict(content=self._content, role=self.role, name=self._name)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    # Compatibility with dict messages
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields or key == 'timestamp':
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
+
+    def keys(self):
+        return self.fields
+
+    def __repr__(self):
+        return f"Message({self.to_dict()!r})"
 
 def sort(messages):
-    return sorted(messages, key=lambda msg: msg.timestamp)
+    return sorted(messages, key=lambda msg: msg.seq)
+
+# Upper bound of the tokens added by truncate's marker
+TRUNCATION_MARKER_TOKENS = 32
 
 def truncate(string, max_tokens=2000):
-    tokens = tokenize(string)
+    # A token spans at least one utf-8 byte, so short strings can't exceed the limit
+    if len(string) * 4 <= max_tokens:
+        return string
+    tokens = tokenizer.encode(string)
     if len(tokens) > max_tokens:
         removed = len(tokens) - max_tokens
-        truncated = tokens[:max_tokens // 2] + [f"\n\n#####\n\n[Maximal message size reached: {removed} tokens truncated]\n\n#####\n\n"] + tokens[-max_tokens // 2:]
-        return ''.join(truncated)
+        # Only the kept head and tail are decoded
+        head = tokenizer.decode(tokens[:max_tokens // 2])
+        tail = tokenizer.decode(tokens[-max_tokens // 2:])
+        return head + f"\n\n#####\n\n[Maximal message size reached: {removed} tokens truncated]\n\n#####\n\n" + tail
     else:
         return string
 
@@ -71,6 +165,17 @@ def pack_msgs(messages):
 def total_tokens(messages):
     return token_count(pack_msgs(messages))
 
+def run_sync(coro):
+    """
+    runs a coroutine to completion, in a separate thread if an event loop is already running (e.g. in a notebook)
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
 def extract_python(text, pattern=None):
     pattern = pattern or r'```run_python(.*?)```'
     iterator = re.finditer(pattern, text, re.DOTALL)
@@ -1,6 +1,7 @@
-from queue import Queue
+from queue import Queue, Full
 from inspect import isgenerator
-from threading import Thread
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
 from .utils import tokenize
 import time
 import io
@@ -8,6 +9,30 @@ from pydub import AudioSegment
 from pydub.playback import play
 from openai import OpenAI
 
+class Sentinel:
+    """
+    Marker object passed through the speech queues
+    """
+    def __init__(self,name):
+        self.name=name
+
+    def __repr__(self):
+        return f"<{self.name}>"
+
+END=Sentinel("END")
+STOP=Sentinel("STOP")
+
+class SpeechJob:
+    """
+    A token stream being spoken. Every queued item is tagged with its job, so that the items of a cancelled job are dropped.
+    """
+    def __init__(self,stream):
+        self.stream=stream
+        self.cancelled=Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
 def get_flags(line,specials):
     for begin, end in specials:
         if line.strip().startswith(begin):
@@ -22,14 +47,29 @@ class VoiceProcessor:
     Speaks the stream as it goes.
     Returns a token stream synchronized with speech.
     The thread_decorator is meant for Streamlit compatibility (to decorate Threads with add_script_run_ctx).
+    Speech is synthesized up to lookahead lines ahead of playback, consecutive short lines being merged
+    into requests of at least min_chars characters.
+    The pipeline runs on three long-lived worker threads (line splitting, pacing, playback) started on first use.
+    A job whose output is not fully consumed (e.g. interrupted by the user) is cancelled.
     """
-    def __init__(self,agent):
+    def __init__(self,agent,lookahead=3,min_chars=60,max_pending_tokens=1000):
         self.client=OpenAI()
         self.agent=agent
-        self.line_queue=Queue()
-        self.audio_queue=Queue()
-        self.output_queue=Queue()
+        self.lookahead=lookahead
+        self.min_chars=min_chars
+        self.synthesizer=ThreadPoolExecutor(max_workers=lookahead)
+        # Bounded queues: each stage blocks when the next one lags behind
+        self.job_queue=Queue()
+        self.audio_queue=Queue(maxsize=lookahead)
+        self.play_queue=Queue(maxsize=1)
+        self.output_queue=Queue(maxsize=max_pending_tokens)
+        self.played=Event()
         self.specials=[("```","```"),("\\[","\\]"),("$$","$$")]
+        self.gaps=[]
+        self.last_end=None
+        self.current_job=None
+        self.workers=[]
+        self.lock=Lock()
 
     def text_to_audio(self,text,voice="shimmer"):
         # Create MP3 audio
@@ -49,6 +89,7 @@ class VoiceProcessor:
 
             mp3_buffer.seek(0)
 
+            # Decoded once here, played as is
             audio = AudioSegment.from_file(mp3_buffer,format="mp3").set_channels(1)
 
             # Extract audio properties
@@ -59,6 +100,7 @@ class VoiceProcessor:
             # Return the required dictionary
             return {
                 "bytes": mp3_buffer.getvalue(),
+                "segment": audio,
                 "sample_rate": sample_rate,
                 "sample_width": sample_width,
                 "length": length
@@ -67,105 +109,172 @@ class VoiceProcessor:
             return None
         
     def play_audio(self,audio):
-        if audio is not None and audio.get("bytes"):
-            audio_file_like = io.BytesIO(audio["bytes"])
-            audio_segment = AudioSegment.from_file(audio_file_like, format="mp3") 
-            play(audio_segment)
-
-    def line_splitter(self,stream):
-        self.line_queue=Queue()
-        def target(stream):
-            line=""
-            for chunk in stream:
-                while '\n' in chunk:
-                    parts=chunk.split('\n')
-                    line+=parts[0]
-                    self.line_queue.put(line)
-                    chunk='\n'.join(parts[1:])
-                    line=""
-                else:
-                    line+=chunk
-            if line:
-                self.line_queue.put(line)
-            self.line_queue.put("#END#")
-
-        thread=Thread(target=target,args=(stream,))
-        thread.start()
-
-        def reader():
-            while not (line:=self.line_queue.get())=="#END#":
-                yield line
-        return reader()
-        
-    def line_processor(self,stream):
-        self.audio_queue=Queue()
-        def target(stream):
+        if audio is not None and audio.get("segment") is not None:
+            play(audio["segment"])
+
+    def start(self):
+        with self.lock:
+            if not self.workers:
+                for target in (self.line_worker,self.pace_worker,self.play_worker):
+                    thread=Thread(target=target,daemon=True)
+                    thread.start()
+                    self.workers.append(thread)
+
+    def close(self):
+        """
+        cancels the current job and stops the worker threads
+        """
+        self.cancel()
+        with self.lock:
+            if self.workers:
+                self.job_queue.put(STOP)
+                for thread in self.workers:
+                    thread.join()
+                self.workers=[]
+        self.synthesizer.shutdown(wait=False,cancel_futures=True)
+
+    def cancel(self,job=None):
+        job=job or self.current_job
+        if job:
+            job.cancel()
+
+    def put(self,queue,item,job):
+        # Blocking put that gives up as soon as the job is cancelled
+        while not job.cancelled.is_set():
+            try:
+                queue.put(item,timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def split_lines(self,stream):
+        line=""
+        for chunk in stream:
+            *lines,chunk=chunk.split('\n')
+            for part in lines:
+                yield line+part
+                line=""
+            line+=chunk
+        if line:
+            yield line
+
+    def line_worker(self):
+        while (job:=self.job_queue.get()) is not STOP:
             flag=None
-            for line in self.line_splitter(stream):
-                if self.agent.config.voice_enabled and line:
-                    begin,end=get_flags(line,self.specials)
-                    if begin and not flag:
-                        flag=end
-                        audio=None
-                    elif flag and line.strip().startswith(flag):
-                        flag=None
-                        audio=None
-                    elif flag:
-                        audio=None
+            group=[]
+            def submit_group():
+                if group:
+                    text='\n'.join(group)
+                    future=self.synthesizer.submit(self.text_to_audio,' '.join(group),voice=self.agent.config.voice)
+                    group.clear()
+                    if not self.put(self.audio_queue,(job,text,future),job):
+                        future.cancel()
+            try:
+                for line in self.split_lines(job.stream):
+                    if job.cancelled.is_set():
+                        break
+                    speakable=False
+                    if self.agent.config.voice_enabled and line:
+                        begin,end=get_flags(line,self.specials)
+                        if begin and not flag:
+                            flag=end
+                        elif flag and line.strip().startswith(flag):
+                            flag=None
+                        elif not flag:
+                            speakable=True
+                    if speakable:
+                        group.append(line)
+                        if sum(len(part) for part in group)>=self.min_chars:
+                            submit_group()
                     else:
-                        audio=self.text_to_audio(line,voice=self.agent.config.voice)
-                else:
-                    audio=None
-                self.audio_queue.put((line,audio))
-            self.audio_queue.put("#END#")
-
-        thread=Thread(target=target,args=(stream,))
-        thread.start()
-
-        def reader():
-            while not (content:=self.audio_queue.get())=="#END#":
-                yield content
-        return reader()
-    
-    def process(self,line,audio):
-        if audio:
-            def target1(line):
-                tokenized=tokenize(line)
-                sleep_time_per_token = 0.95*(audio['length'] / len(tokenized))  # Durée ajustée par token
-                for token in tokenized:
-                    self.output_queue.put(token)
-                    time.sleep(sleep_time_per_token)
-                self.output_queue.put('\n')
-        else:
-            def target1(line):
-                for token in tokenize(line):
-                    self.output_queue.put(token)
-                    time.sleep(0.02)
-                self.output_queue.put('\n')
-            
-        def target2(audio):
-            self.play_audio(audio)
-        thread1=Thread(target=target1,args=(line,))
-        thread1.start()
-        if self.agent.config.voice_enabled:
-            thread2=Thread(target=target2,args=(audio,))
-            thread2.start()
-        thread1.join()
-        if self.agent.config.voice_enabled:
-            thread2.join()
+                        submit_group()
+                        self.put(self.audio_queue,(job,line,None),job)
+                submit_group()
+            except Exception as e:
+                self.put(self.audio_queue,(job,f"Speech error: {e}",None),job)
+            finally:
+                if isgenerator(job.stream):
+                    job.stream.close()
+            self.put(self.audio_queue,(job,END,None),job)
+        self.audio_queue.put((None,STOP,None))
+
+    def pace_worker(self):
+        while (item:=self.audio_queue.get())[1] is not STOP:
+            job,text,future=item
+            if job.cancelled.is_set():
+                if future:
+                    future.cancel()
+                continue
+            if text is END:
+                self.put(self.output_queue,(job,END),job)
+                continue
+            try:
+                audio=future.result() if future else None
+            except Exception:
+                audio=None
+            tokens=tokenize(text)
+            if audio and self.agent.config.voice_enabled:
+                self.played.clear()
+                playing=self.put(self.play_queue,(job,audio),job)
+                delay=0.95*audio['length']/max(len(tokens),1)
+            else:
+                playing=False
+                delay=0.02
+            for token in tokens+['\n']:
+                if not self.put(self.output_queue,(job,token),job):
+                    break
+                time.sleep(delay)
+            while playing and not self.played.wait(0.1) and not job.cancelled.is_set():
+                pass
+        self.play_queue.put((None,STOP))
+
+    def play_worker(self):
+        while (item:=self.play_queue.get())[1] is not STOP:
+            job,audio=item
+            if not job.cancelled.is_set():
+                if self.last_end is not None:
+                    self.gaps.append(time.time()-self.last_end)
+                self.play_audio(audio)
+                self.last_end=time.time()
+            self.played.set()
+
+    def reader(self,job):
+        done=False
+        try:
+            while True:
+                item_job,token=self.output_queue.get()
+                if item_job is not job:
+                    # Leftover of a cancelled job
+                    continue
+                if token is END:
+                    done=True
+                    return
+                yield token
+        finally:
+            if not done:
+                job.cancel()
 
     def speak(self,stream):
         if self.agent.config.voice_enabled and not self.agent.silent:
-            def target(stream):
-                self.output_queue=Queue()
-                for line,audio in self.line_processor(stream):
-                    self.process(line,audio)
-                self.output_queue.put("#END#")
-            thread=Thread(target=target,args=(stream,))
-            thread.start()
-            def reader():
-                while not (token:=self.output_queue.get())=="#END#":
-                    yield token
-            return reader()
+            self.cancel()
+            self.start()
+            job=SpeechJob(stream)
+            self.current_job=job
+            self.gaps=[]
+            self.last_end=None
+            self.job_queue.put(job)
+            return self.reader(job)
         else:
-            return stream
\ No newline at end of file
+            return stream
+
+    def speech_stats(self):
+        """
+        reports the silences between consecutive spoken clips of a response
+        """
+        gaps=self.gaps
+        return dict(
+            gaps=len(gaps),
+            mean_gap=sum(gaps)/len(gaps) if gaps else 0.0,
+            max_gap=max(gaps) if gaps else 0.0
+        )